@@ -1,27 +1,50 @@
 import os
 import sqlite3
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List, Callable, Tuple
+from typing import Optional, Dict, Any, List, Callable, Tuple, Iterator, Iterable
 from functools import wraps
 import secrets
 import hmac
 import hashlib
 import json
-
+import csv
+import io
+import gzip
+import shutil
+import threading
+import time
+import math
+import re
+import pathlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import click
 from werkzeug.security import check_password_hash, generate_password_hash
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    send_file, jsonify, flash, session
+    send_file, jsonify, flash, session, has_request_context,
+    Response, stream_template, get_flashed_messages, send_from_directory
 )
-from barcode import Code128
-from barcode.writer import ImageWriter
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import safe_join
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(APP_DIR, "inventory.db")
-LABELS_DIR = os.path.join(APP_DIR, "labels")
+DB_PATH = os.environ.get("DB_PATH", os.path.join(APP_DIR, "inventory.db"))
+LABELS_DIR = os.environ.get("LABELS_DIR", os.path.join(APP_DIR, "labels"))
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(APP_DIR, "backups"))
+
+# ✅ TLS opzionale per "serve" (es. //HOMEASSISTANT/ssl/fullchain.pem e privkey.pem)
+SSL_CERT = os.environ.get("SSL_CERT", "")
+SSL_KEY = os.environ.get("SSL_KEY", "")
 
-ssl_file = "//HOMEASSISTANT/ssl/privkey.pem"
-ssl_cert = "//HOMEASSISTANT/ssl/fullchain.pem"
+# ✅ Server di produzione: processi worker e thread per worker
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "8086"))
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", "2"))
+SERVE_THREADS = int(os.environ.get("SERVE_THREADS", "8"))
 
 # ✅ Soglie GLOBALI (uguali per tutti)
 DEFAULT_GLOBAL_WARN_DAYS = 180
@@ -45,6 +68,73 @@ SETTINGS_KEY_BARCODE_TEXT_DISTANCE = "barcode_text_distance"
 SETTINGS_KEY_BARCODE_WRITE_TEXT = "barcode_write_text"
 SETTINGS_KEY_BARCODE_SETTINGS_HASH = "barcode_settings_hash"
 SETTINGS_KEY_ADMIN_PASSWORD_HASH = "admin_password_hash"
+SETTINGS_KEY_DERIVED_GENERATION = "derived_generation"
+SETTINGS_KEY_CATALOG_GENERATION = "catalog_generation"
+
+# ✅ Backup online (sqlite3 backup API): pagine per step, pausa tra gli step, ripartenze
+# tollerate prima di passare a VACUUM INTO, numero di copie da mantenere (0 = tutte),
+# compressione gzip e intervallo automatico (0 = disattivo)
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.environ.get("BACKUP_STEP_SLEEP", "0.01"))
+BACKUP_MAX_RESTARTS = int(os.environ.get("BACKUP_MAX_RESTARTS", "3"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "14"))
+BACKUP_COMPRESS = os.environ.get("BACKUP_COMPRESS", "1").strip().lower() in ("1", "true", "yes", "on")
+BACKUP_INTERVAL_HOURS = float(os.environ.get("BACKUP_INTERVAL_HOURS", "0"))
+BACKUP_PREFIX = "inventory-"
+
+# ✅ Etichette orfane: età minima (secondi) prima di eliminarle, per non togliere
+# file a richieste ancora in corso con il vecchio hash
+LABEL_GC_GRACE_SECONDS = float(os.environ.get("LABEL_GC_GRACE_SECONDS", "3600"))
+
+# ✅ Connessioni in sola lettura per le pagine pubbliche (per sito e per processo)
+READ_POOL_SIZE = int(os.environ.get("READ_POOL_SIZE", "8"))
+
+# ✅ Previsione soglie: finestra per il ritmo d'uso e orizzonte della lista "in scadenza"
+FORECAST_WINDOW_DAYS = 90
+FORECAST_HORIZON_DAYS = 30
+
+# ✅ Schede tampone tenute in memoria (per processo)
+TIMELINE_CACHE_SIZE = int(os.environ.get("TIMELINE_CACHE_SIZE", "256"))
+
+# ✅ Notifiche superamento soglie: destinazioni (vuote = disattivate), raggruppamento,
+# attesa crescente tra i tentativi (dopo NOTIFY_RETRIES si logga un errore ma si continua),
+# intervallo di controllo della coda su DB e passaggio periodico per i tamponi che invecchiano in uso
+NOTIFY_WEBHOOK_URL = os.environ.get("NOTIFY_WEBHOOK_URL", "")
+NOTIFY_SMTP_HOST = os.environ.get("NOTIFY_SMTP_HOST", "")
+NOTIFY_SMTP_PORT = int(os.environ.get("NOTIFY_SMTP_PORT", "25"))
+NOTIFY_SMTP_USER = os.environ.get("NOTIFY_SMTP_USER", "")
+NOTIFY_SMTP_PASSWORD = os.environ.get("NOTIFY_SMTP_PASSWORD", "")
+NOTIFY_SMTP_STARTTLS = os.environ.get("NOTIFY_SMTP_STARTTLS", "0").strip().lower() in ("1", "true", "yes", "on")
+NOTIFY_SMTP_FROM = os.environ.get("NOTIFY_SMTP_FROM", "tamponi@localhost")
+NOTIFY_SMTP_TO = os.environ.get("NOTIFY_SMTP_TO", "")
+NOTIFY_FILE = os.environ.get("NOTIFY_FILE", "")
+NOTIFY_SYSLOG = os.environ.get("NOTIFY_SYSLOG", "")
+NOTIFY_BATCH_SECONDS = float(os.environ.get("NOTIFY_BATCH_SECONDS", "5"))
+NOTIFY_BATCH_MAX = int(os.environ.get("NOTIFY_BATCH_MAX", "50"))
+NOTIFY_RETRIES = int(os.environ.get("NOTIFY_RETRIES", "5"))
+NOTIFY_BACKOFF_SECONDS = float(os.environ.get("NOTIFY_BACKOFF_SECONDS", "2"))
+NOTIFY_BACKOFF_MAX_SECONDS = float(os.environ.get("NOTIFY_BACKOFF_MAX_SECONDS", "300"))
+NOTIFY_POLL_SECONDS = float(os.environ.get("NOTIFY_POLL_SECONDS", "30"))
+NOTIFY_AGING_INTERVAL_HOURS = float(os.environ.get("NOTIFY_AGING_INTERVAL_HOURS", "24"))
+
+# ✅ Snapshot periodici dello stato per le interrogazioni storiche (0 = disattivo)
+# e quanti tenerne (i più vecchi vengono eliminati; 0 = tutti)
+SNAPSHOT_INTERVAL_HOURS = float(os.environ.get("SNAPSHOT_INTERVAL_HOURS", "24"))
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "30"))
+
+# ✅ Stampanti termiche ZPL: risoluzione in dpi e stampanti raw TCP ("Banco1=10.0.0.5:9100,Banco2=10.0.0.6")
+ZPL_DPI = int(os.environ.get("ZPL_DPI", "203"))
+ZPL_PRINTERS = os.environ.get("ZPL_PRINTERS", "")
+ZPL_SEND_TIMEOUT = float(os.environ.get("ZPL_SEND_TIMEOUT", "10"))
+
+# ✅ Scanner camera servito solo da static/vendor, mai da CDN (rete di impianto isolata):
+# lettore Code128 incluso nel repository; html5-qrcode, se installato con
+# `flask --app app fetch-assets` (o `fetch-assets --from <file>`), ha la precedenza
+HTML5_QRCODE_VERSION = "2.3.8"
+HTML5_QRCODE_URL = f"https://unpkg.com/html5-qrcode@{HTML5_QRCODE_VERSION}/html5-qrcode.min.js"
+HTML5_QRCODE_ASSET = "vendor/html5-qrcode.min.js"
+BUILTIN_SCANNER_ASSET = "vendor/code128-scanner.js"
+ASSET_MAX_AGE = 365 * 24 * 3600
 
 # ✅ Password admin (imposta variabile ambiente ADMIN_PASSWORD)
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "admin")
@@ -56,11 +146,140 @@ app.secret_key = os.environ.get("FLASK_SECRET_KEY", secrets.token_hex(32))
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 60 * 60 * 24
 
 
+# ---------------------------
+# Siti (un database e una cartella etichette per laboratorio)
+# ---------------------------
+DEFAULT_SITE_ID = "default"
+SITES_FILE = os.environ.get("SITES_FILE", os.path.join(APP_DIR, "sites.json"))
+SITE_ENVIRON_KEY = "tamponi.site"
+SITE_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def load_sites() -> Dict[str, Dict[str, Any]]:
+    """
+    Il sito "default" usa DB_PATH / LABELS_DIR / BACKUP_DIR. Altri siti da sites.json:
+      { "lab2": { "name": "Lab 2", "db": "...", "labels": "...", "backups": "...", "hosts": ["lab2.local"] } }
+    Percorsi relativi alla cartella dell'app; se omessi: sites/<id>/...
+    """
+    sites: Dict[str, Dict[str, Any]] = {
+        DEFAULT_SITE_ID: {
+            "id": DEFAULT_SITE_ID,
+            "name": "Sede principale",
+            "db": DB_PATH,
+            "labels": LABELS_DIR,
+            "backups": BACKUP_DIR,
+            "hosts": [],
+        },
+    }
+    if not os.path.exists(SITES_FILE):
+        return sites
+    with open(SITES_FILE, "r", encoding="utf-8") as handle:
+        config = json.load(handle)
+    for site_id, cfg in config.items():
+        if not SITE_ID_RE.match(site_id):
+            raise ValueError(f"ID sito non valido in {SITES_FILE}: {site_id!r}")
+        base = os.path.join("sites", site_id)
+        entry = sites.setdefault(site_id, {"id": site_id})
+        entry["name"] = cfg.get("name", entry.get("name", site_id))
+        for key, default in (("db", os.path.join(base, "inventory.db")),
+                             ("labels", os.path.join(base, "labels")),
+                             ("backups", os.path.join(base, "backups"))):
+            if key in cfg or key not in entry:
+                entry[key] = os.path.join(APP_DIR, cfg.get(key, default))
+        entry["hosts"] = [h.lower() for h in cfg.get("hosts", [])]
+    return sites
+
+
+SITES = load_sites()
+SITE_HOSTS = {host: site_id for site_id, site in SITES.items() for host in site["hosts"]}
+_current_site: ContextVar[Optional[str]] = ContextVar("current_site", default=None)
+
+
+def current_site_id() -> str:
+    explicit = _current_site.get()
+    if explicit:
+        return explicit
+    if has_request_context():
+        return request.environ.get(SITE_ENVIRON_KEY, DEFAULT_SITE_ID)
+    return DEFAULT_SITE_ID
+
+
+def current_site() -> Dict[str, Any]:
+    return SITES[current_site_id()]
+
+
+def site_db_path() -> str:
+    return current_site()["db"]
+
+
+def site_labels_dir() -> str:
+    return current_site()["labels"]
+
+
+def site_backup_dir() -> str:
+    return current_site()["backups"]
+
+
+@contextmanager
+def use_site(site_id: str):
+    """Per thread in background, CLI e fan-out: lavora sul sito indicato."""
+    token = _current_site.set(site_id)
+    try:
+        yield SITES[site_id]
+    finally:
+        _current_site.reset(token)
+
+
+def for_each_site(job: Callable[[], Any]) -> None:
+    for site_id in SITES:
+        with use_site(site_id):
+            job()
+
+
+class SiteDispatcher:
+    """
+    Middleware WSGI: /site/<id>/... (oppure l'Host configurato) sceglie il sito.
+    Il prefisso finisce in SCRIPT_NAME, quindi url_for genera già link con /site/<id>.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path.startswith("/site/"):
+            parts = path.split("/", 3)
+            site_id = parts[2]
+            if site_id not in SITES:
+                return NotFound()(environ, start_response)
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + f"/site/{site_id}"
+            environ["PATH_INFO"] = "/" + (parts[3] if len(parts) > 3 else "")
+        else:
+            host = environ.get("HTTP_HOST", "").split(":")[0].lower()
+            site_id = SITE_HOSTS.get(host, DEFAULT_SITE_ID)
+        environ[SITE_ENVIRON_KEY] = site_id
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = SiteDispatcher(app.wsgi_app)
+
+
+def site_option(func: Callable) -> Callable:
+    return click.option(
+        "--site",
+        default=DEFAULT_SITE_ID,
+        show_default=True,
+        type=click.Choice(list(SITES)),
+        help="Sito su cui operare.",
+    )(func)
+
+
 # ---------------------------
 # Auth helpers
 # ---------------------------
 def is_logged_in() -> bool:
-    return bool(session.get("admin_logged", False))
+    # login per sito: l'admin di un laboratorio non lo è automaticamente degli altri
+    return current_site_id() in session.get("admin_sites", [])
 
 
 def require_admin(view_func: Callable):
@@ -74,12 +293,12 @@ def require_admin(view_func: Callable):
 
 @app.context_processor
 def inject_auth():
-    return {"is_admin": is_logged_in()}
+    return {"is_admin": is_logged_in(), "site": current_site(), "multi_site": len(SITES) > 1}
 
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
-    init_db()
+    ensure_db()
     if request.method == "POST":
         pw = request.form.get("password", "")
         with connect() as con:
@@ -92,7 +311,7 @@ def login():
                     set_setting(con, SETTINGS_KEY_ADMIN_PASSWORD_HASH, generate_password_hash(ADMIN_PASSWORD))
                     con.commit()
             if ok:
-                session["admin_logged"] = True
+                session["admin_sites"] = sorted(set(session.get("admin_sites", [])) | {current_site_id()})
                 flash("Accesso effettuato.", "ok")
                 return redirect(url_for("admin_dashboard"))
         flash("Password errata.", "error")
@@ -118,12 +337,74 @@ def ensure_dir(path: str) -> None:
 
 
 def connect() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(site_db_path())
     con.row_factory = sqlite3.Row
     con.execute("PRAGMA foreign_keys = ON;")
+    con.execute("PRAGMA busy_timeout = 5000;")
     return con
 
 
+def readonly_uri(path: str) -> str:
+    # as_uri() fa il quoting di spazi, ?, #, % e gestisce i percorsi Windows (file:///C:/...)
+    return pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+
+
+class ReadOnlyPool:
+    """
+    Connessioni aperte con mode=ro + query_only: con WAL i lettori non prendono
+    mai il lock di scrittura e non competono con gli INSERT di /api/scan.
+    """
+
+    def __init__(self, db_path: str, size: int):
+        self.db_path = db_path
+        self.size = size
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        con = sqlite3.connect(readonly_uri(self.db_path), uri=True, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA query_only = ON;")
+        con.execute("PRAGMA busy_timeout = 5000;")
+        return con
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def release(self, con: sqlite3.Connection) -> None:
+        if con.in_transaction:
+            con.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(con)
+                return
+        con.close()
+
+
+_read_pools_lock = threading.Lock()
+_read_pools: Dict[str, ReadOnlyPool] = {}
+# connessioni ereditate da un fork: non vanno né usate né chiuse nel figlio
+_forked_read_pools: List[ReadOnlyPool] = []
+
+
+@contextmanager
+def read_connection():
+    """Connessione in sola lettura dal pool del sito corrente."""
+    site_id = current_site_id()
+    with _read_pools_lock:
+        pool = _read_pools.get(site_id)
+        if pool is None:
+            pool = _read_pools[site_id] = ReadOnlyPool(site_db_path(), READ_POOL_SIZE)
+    con = pool.acquire()
+    try:
+        yield con
+    finally:
+        pool.release(con)
+
+
 def parse_iso(ts: str) -> datetime:
     return datetime.fromisoformat(ts)
 
@@ -139,16 +420,33 @@ def iter_dates_inclusive(start_date, end_date):
         cur += timedelta(days=1)
 
 
-def calendar_days_between(start_iso: str, end_iso: str) -> int:
-    a_dt = parse_iso(start_iso)
-    b_dt = parse_iso(end_iso)
-    if a_dt.date() == b_dt.date() and (b_dt - a_dt) <= timedelta(hours=2):
+EPOCH = datetime(1970, 1, 1)
+DAY_SECONDS = 86400
+SAME_DAY_GRACE_SECONDS = 2 * 3600
+
+
+def iso_to_epoch(ts: str) -> int:
+    # I timestamp sono ora locale senza fuso: trattati come UTC, come fa strftime('%s') in SQLite
+    return int((parse_iso(ts) - EPOCH).total_seconds())
+
+
+def now_epoch() -> int:
+    return iso_to_epoch(now_iso())
+
+
+def calendar_days_between_epoch(start: int, end: int) -> int:
+    start_day, end_day = start // DAY_SECONDS, end // DAY_SECONDS
+    if start_day == end_day and end - start <= SAME_DAY_GRACE_SECONDS:
         return 0
-    return (b_dt.date() - a_dt.date()).days + 1
+    return end_day - start_day + 1
+
+
+def epoch_day_to_key(day_num: int) -> str:
+    return date_to_key(EPOCH + timedelta(days=day_num))
 
 
-def current_calendar_days(start_iso: str) -> int:
-    return calendar_days_between(start_iso, now_iso())
+def current_calendar_days(start_epoch: int, now: Optional[int] = None) -> int:
+    return calendar_days_between_epoch(start_epoch, now_epoch() if now is None else now)
 
 
 @app.template_filter("it_datetime")
@@ -165,9 +463,25 @@ def compute_barcode_settings_hash(settings: Dict[str, Any]) -> str:
     return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
 
+# colonne generate (3.31) e INSERT/UPDATE ... RETURNING di /api/scan (3.35)
+SQLITE_MIN_VERSION = (3, 35, 0)
+
+
+def check_sqlite_version() -> None:
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise RuntimeError(
+            f"SQLite {sqlite3.sqlite_version} troppo vecchio: serve almeno "
+            f"{'.'.join(map(str, SQLITE_MIN_VERSION))} (RETURNING). Aggiorna Python o la libreria sqlite3."
+        )
+
+
 def init_db() -> None:
-    ensure_dir(LABELS_DIR)
+    check_sqlite_version()
+    ensure_dir(os.path.dirname(site_db_path()))
+    ensure_dir(site_labels_dir())
     with connect() as con:
+        # WAL: i lettori (backup compreso) non bloccano le scritture delle scansioni
+        con.execute("PRAGMA journal_mode=WAL;")
         con.executescript(
             """
             CREATE TABLE IF NOT EXISTS swabs (
@@ -232,8 +546,54 @@ def init_db() -> None:
                 key TEXT PRIMARY KEY,
                 value TEXT NOT NULL
             );
+
+            -- Snapshot periodici di swab_state + contatori giorni: le interrogazioni
+            -- storiche ripartono dallo snapshot più vicino e rigiocano solo i
+            -- movimenti successivi (id > last_movement_id)
+            CREATE TABLE IF NOT EXISTS state_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                taken_at TEXT NOT NULL,
+                last_movement_id INTEGER NOT NULL
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_state_snapshots_taken_at ON state_snapshots(taken_at);
+
+            -- Ultimo livello notificato per tampone (0 nessuno, 1 avviso, 2 allarme):
+            -- si notifica solo quando il livello sale, una volta per superamento
+            CREATE TABLE IF NOT EXISTS alert_levels (
+                swab_id INTEGER PRIMARY KEY,
+                level INTEGER NOT NULL,
+                changed_at TEXT NOT NULL,
+                FOREIGN KEY(swab_id) REFERENCES swabs(id) ON DELETE CASCADE
+            );
+
+            -- Notifiche da consegnare, una riga per (destinazione, evento): scritte nella
+            -- stessa transazione di alert_levels, eliminate solo a consegna avvenuta
+            CREATE TABLE IF NOT EXISTS alert_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sink TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_alert_outbox_sink ON alert_outbox(sink, next_attempt);
+
+            CREATE TABLE IF NOT EXISTS state_snapshot_rows (
+                snapshot_id INTEGER NOT NULL,
+                swab_id INTEGER NOT NULL,
+                in_stock INTEGER NOT NULL,
+                machine_id INTEGER,
+                open_taken_ts TEXT,
+                total_days INTEGER NOT NULL,
+                last_day TEXT,
+                PRIMARY KEY(snapshot_id, swab_id),
+                FOREIGN KEY(snapshot_id) REFERENCES state_snapshots(id) ON DELETE CASCADE
+            ) WITHOUT ROWID;
             """
         )
+        migrate_epoch_columns(con)
         con.execute(
             "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
             (SETTINGS_KEY_WARN_DAYS, str(DEFAULT_GLOBAL_WARN_DAYS)),
@@ -283,6 +643,53 @@ def init_db() -> None:
         con.commit()
 
 
+# Colonne intere (secondi / giorni dall'epoch) accanto ai timestamp ISO TEXT.
+# Sono colonne generate VIRTUAL: SQLite le calcola dal testo, quindi restano
+# sempre allineate senza toccare le INSERT/UPDATE esistenti, e si possono
+# indicizzare per le interrogazioni a intervalli. Richiede SQLite >= 3.31
+# (l'app nel complesso >= 3.35, vedi SQLITE_MIN_VERSION).
+EPOCH_COLUMNS = [
+    ("movements", "ts_epoch", "CAST(strftime('%s', ts) AS INTEGER)"),
+    ("usage_sessions", "taken_epoch", "CAST(strftime('%s', taken_ts) AS INTEGER)"),
+    ("usage_sessions", "returned_epoch", "CAST(strftime('%s', returned_ts) AS INTEGER)"),
+    ("swab_state", "updated_epoch", "CAST(strftime('%s', updated_at) AS INTEGER)"),
+    ("usage_days", "day_num", "CAST(strftime('%s', day) AS INTEGER) / 86400"),
+]
+
+EPOCH_INDEXES = """
+    DROP INDEX IF EXISTS idx_movements_ts;
+    CREATE INDEX IF NOT EXISTS idx_movements_ts_epoch ON movements(ts_epoch);
+    CREATE INDEX IF NOT EXISTS idx_movements_swab_epoch ON movements(swab_id, ts_epoch);
+    CREATE INDEX IF NOT EXISTS idx_usage_sessions_swab_taken ON usage_sessions(swab_id, taken_epoch);
+    CREATE INDEX IF NOT EXISTS idx_usage_days_swab_num ON usage_days(swab_id, day_num);
+    CREATE INDEX IF NOT EXISTS idx_swab_state_updated ON swab_state(updated_epoch);
+"""
+
+
+def migrate_epoch_columns(con: sqlite3.Connection) -> None:
+    for table, column, expr in EPOCH_COLUMNS:
+        # table_xinfo (non table_info) elenca anche le colonne generate
+        existing = {r["name"] for r in con.execute(f"PRAGMA table_xinfo({table})")}
+        if column not in existing:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER GENERATED ALWAYS AS ({expr}) VIRTUAL")
+    con.executescript(EPOCH_INDEXES)
+
+
+_ready_sites: set = set()
+_ready_sites_lock = threading.Lock()
+
+
+def ensure_db() -> None:
+    """init_db una sola volta per sito e per processo: le GET non scrivono più a ogni richiesta."""
+    site_id = current_site_id()
+    if site_id in _ready_sites:
+        return
+    with _ready_sites_lock:
+        if site_id not in _ready_sites:
+            init_db()
+            _ready_sites.add(site_id)
+
+
 def get_setting(con: sqlite3.Connection, key: str) -> Optional[str]:
     row = con.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
     return row["value"] if row else None
@@ -297,7 +704,10 @@ def set_setting(con: sqlite3.Connection, key: str, value: str) -> None:
 
 
 def get_positive_setting(con: sqlite3.Connection, key: str, default: int) -> int:
-    raw = get_setting(con, key)
+    return parse_positive_int(get_setting(con, key), default)
+
+
+def parse_positive_int(raw: Optional[str], default: int) -> int:
     try:
         value = int(raw) if raw is not None else default
     except (TypeError, ValueError):
@@ -378,7 +788,10 @@ def get_barcode_settings_hash(con: sqlite3.Connection) -> str:
     if current:
         return current
     computed = compute_barcode_settings_hash(get_barcode_settings(con))
-    set_setting(con, SETTINGS_KEY_BARCODE_SETTINGS_HASH, computed)
+    try:
+        set_setting(con, SETTINGS_KEY_BARCODE_SETTINGS_HASH, computed)
+    except sqlite3.OperationalError:
+        pass  # connessione in sola lettura: il valore calcolato basta
     return computed
 
 
@@ -409,75 +822,1814 @@ def set_state(con: sqlite3.Connection, swab_id: int, in_stock: int, machine_id:
     )
 
 
-def ensure_label_png(sku: str) -> str:
-    ensure_dir(LABELS_DIR)
-    out_path = os.path.join(LABELS_DIR, f"{sku}.png")
-    hash_path = os.path.join(LABELS_DIR, f"{sku}.hash")
+_barcode_classes: Optional[Tuple[Any, Any]] = None
+
+
+def load_barcode_classes() -> Tuple[Any, Any]:
+    """
+    Importa python-barcode (e con lui Pillow) solo al primo uso: i processi
+    che servono solo scansioni non pagano il tempo di import né la memoria.
+    """
+    global _barcode_classes
+    if _barcode_classes is None:
+        from barcode import Code128
+        from barcode.writer import ImageWriter
+        _barcode_classes = (Code128, ImageWriter)
+    return _barcode_classes
+
+
+def label_path(sku: str, settings_hash: str) -> str:
+    # etichette indirizzate per (sku, hash impostazioni): vecchie e nuove convivono
+    return os.path.join(site_labels_dir(), settings_hash, f"{sku}.png")
+
+
+def render_label_png(sku: str, barcode_settings: Dict[str, Any], settings_hash: str) -> str:
+    out_path = label_path(sku, settings_hash)
+    if os.path.exists(out_path):
+        return out_path
+
+    ensure_dir(os.path.dirname(out_path))
+    Code128, ImageWriter = load_barcode_classes()
+    code = Code128(sku, writer=ImageWriter())
+    # scrittura su file temporaneo + rename atomico: più thread/processi possono
+    # renderizzare la stessa etichetta senza che nessuno legga un PNG a metà
+    tmp_path = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as handle:
+        code.write(handle, options=barcode_settings)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def ensure_label_png(sku: str) -> str:
+    with read_connection() as con:
+        barcode_settings = get_barcode_settings(con)
+        settings_hash = get_barcode_settings_hash(con)
+    return render_label_png(sku, barcode_settings, settings_hash)
+
+
+def gc_labels(settings_hash: str, skus: List[str], grace_seconds: Optional[float] = None) -> int:
+    """
+    Elimina le etichette orfane: hash impostazioni non più corrente,
+    SKU non più esistente, oppure vecchio formato piatto labels/<sku>.png/.hash.
+    Si salta tutto ciò che è stato modificato negli ultimi grace_seconds: altri
+    thread/worker possono ancora renderizzare o servire etichette con il vecchio
+    hash, e un tampone appena creato può avere l'etichetta ma non essere in skus.
+    """
+    grace_seconds = LABEL_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    labels_dir = site_labels_dir()
+    if not os.path.isdir(labels_dir):
+        return 0
+    cutoff = time.time() - grace_seconds
+    valid = {f"{sku}.png" for sku in skus}
+
+    def _expired(path: str) -> bool:
+        try:
+            return os.stat(path).st_mtime < cutoff
+        except FileNotFoundError:
+            return False
+
+    removed = 0
+    for entry in os.listdir(labels_dir):
+        path = os.path.join(labels_dir, entry)
+        if os.path.isdir(path):
+            if entry != settings_hash:
+                # il mtime della cartella cambia a ogni etichetta scritta dentro
+                if _expired(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+                continue
+            for name in os.listdir(path):
+                file_path = os.path.join(path, name)
+                if name not in valid and not name.endswith(".tmp") and _expired(file_path):
+                    os.remove(file_path)
+                    removed += 1
+        elif (entry.endswith(".png") or entry.endswith(".hash")) and _expired(path):
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+_label_job_lock = threading.Lock()
+_label_jobs: Dict[str, Dict[str, Any]] = {}
+
+
+def rerender_all_labels() -> int:
+    """
+    Renderizza tutte le etichette con le impostazioni correnti, poi elimina le orfane.
+    Se le impostazioni cambiano durante il lavoro si riparte con il nuovo hash.
+    """
+    rendered = 0
+    while True:
+        with connect() as con:
+            barcode_settings = get_barcode_settings(con)
+            settings_hash = get_barcode_settings_hash(con)
+            skus = [r["sku"] for r in con.execute("SELECT sku FROM swabs")]
+        for sku in skus:
+            if not os.path.exists(label_path(sku, settings_hash)):
+                render_label_png(sku, barcode_settings, settings_hash)
+                rendered += 1
+        with connect() as con:
+            if get_barcode_settings_hash(con) != settings_hash:
+                continue
+            skus = [r["sku"] for r in con.execute("SELECT sku FROM swabs")]
+        gc_labels(settings_hash, skus)
+        return rendered
+
+
+def start_label_rerender() -> bool:
+    """Avvia il re-render in background; se è già in corso lo fa ripartire alla fine."""
+    site_id = current_site_id()
+    with _label_job_lock:
+        job = _label_jobs.setdefault(site_id, {"thread": None, "pending": False})
+        if job["thread"] is not None:
+            job["pending"] = True
+            return False
+
+        def _run() -> None:
+            with use_site(site_id):
+                while True:
+                    try:
+                        rerender_all_labels()
+                    except Exception as exc:
+                        app.logger.error("Re-render etichette fallito (%s): %s", site_id, exc)
+                    with _label_job_lock:
+                        if not job["pending"]:
+                            job["thread"] = None
+                            return
+                        job["pending"] = False
+
+        t = threading.Thread(target=_run, name=f"label-rerender-{site_id}", daemon=True)
+        job["thread"] = t
+        t.start()
+        return True
+
+
+@app.cli.command("render-labels")
+@site_option
+def render_labels_command(site: str) -> None:
+    """Renderizza tutte le etichette con le impostazioni correnti ed elimina le orfane."""
+    with use_site(site):
+        init_db()
+        print(rerender_all_labels())
+
+
+def usage_day_keys(start_iso: str, end_iso: str) -> List[str]:
+    a_dt = parse_iso(start_iso)
+    b_dt = parse_iso(end_iso)
+    if a_dt.date() == b_dt.date() and (b_dt - a_dt) <= timedelta(hours=2):
+        return []
+    return [date_to_key(d) for d in iter_dates_inclusive(a_dt.date(), b_dt.date())]
+
+
+def list_machines(con: sqlite3.Connection) -> List[Dict[str, Any]]:
+    rows = con.execute("SELECT id, name FROM machines ORDER BY name COLLATE NOCASE").fetchall()
+    return [{"id": int(r["id"]), "name": r["name"]} for r in rows]
+
+
+def machine_exists(con: sqlite3.Connection, machine_id: int) -> bool:
+    r = con.execute("SELECT 1 FROM machines WHERE id=?", (machine_id,)).fetchone()
+    return bool(r)
+
+
+# ---------------------------
+# Etichette ZPL (stampanti termiche)
+# ---------------------------
+ZPL_DEFAULT_PORT = 9100
+
+
+def parse_printers(raw: str) -> Dict[str, Tuple[str, int]]:
+    printers: Dict[str, Tuple[str, int]] = {}
+    for item in raw.split(","):
+        name, sep, address = item.partition("=")
+        if not sep or not name.strip() or not address.strip():
+            continue
+        host, colon, port = address.strip().rpartition(":")
+        if colon and port.isdigit():
+            printers[name.strip()] = (host, int(port))
+        else:
+            printers[name.strip()] = (address.strip(), ZPL_DEFAULT_PORT)
+    return printers
+
+
+LABEL_PRINTERS = parse_printers(ZPL_PRINTERS)
+
+
+def zpl_escape(text: str) -> str:
+    # con ^FH_ i caratteri di controllo ZPL vanno scritti in esadecimale
+    return text.replace("_", "_5F").replace("^", "_5E").replace("~", "_7E")
+
+
+def code128_modules(data: str) -> int:
+    # start + dati + checksum da 11 moduli, stop da 13 (set B: limite superiore)
+    return 11 * (len(data) + 2) + 13
+
+
+def label_zpl(sku: str, barcode_settings: Dict[str, Any], dpi: int = ZPL_DPI, copies: int = 1) -> str:
+    """
+    Stessa etichetta del PNG (impostazioni barcode in mm / pt) come comandi ZPL:
+    Code128 nativo della stampante, nessuna immagine da rasterizzare.
+    """
+    dots_per_mm = dpi / 25.4
+    module = max(1, round(barcode_settings["module_width"] * dots_per_mm))
+    height = max(1, round(barcode_settings["module_height"] * dots_per_mm))
+    quiet = round(barcode_settings["quiet_zone"] * dots_per_mm)
+    width = 2 * quiet + code128_modules(sku) * module
+    data = zpl_escape(sku)
+
+    lines = [
+        "^XA",
+        "^CI28",
+        f"^PW{width}",
+        "^LH0,0",
+        f"^FO{quiet},0^BY{module}^BCN,{height},N,N,N,A^FH_^FD{data}^FS",
+    ]
+    if barcode_settings["write_text"]:
+        font = max(10, round(barcode_settings["font_size"] * 25.4 / 72 * dots_per_mm))
+        top = height + round(barcode_settings["text_distance"] * dots_per_mm)
+        lines.append(f"^FO0,{top}^A0N,{font},{font}^FB{width},1,0,C^FH_^FD{data}^FS")
+    if copies > 1:
+        lines.append(f"^PQ{copies}")
+    lines.append("^XZ")
+    return "\n".join(lines) + "\n"
+
+
+def send_to_printer(address: Tuple[str, int], chunks: Iterable[str]) -> int:
+    """Invia i comandi alla porta raw della stampante (9100) man mano che sono generati."""
+    import socket
+
+    sent = 0
+    with socket.create_connection(address, timeout=ZPL_SEND_TIMEOUT) as sock:
+        for chunk in chunks:
+            payload = chunk.encode("utf-8")
+            sock.sendall(payload)
+            sent += len(payload)
+        sock.shutdown(socket.SHUT_WR)
+    return sent
+
+
+# ---------------------------
+# Backup
+# ---------------------------
+_backup_lock = threading.Lock()
+
+
+def list_backups() -> List[Dict[str, Any]]:
+    backup_dir = site_backup_dir()
+    if not os.path.isdir(backup_dir):
+        return []
+    items: List[Dict[str, Any]] = []
+    for name in os.listdir(backup_dir):
+        if not name.startswith(BACKUP_PREFIX) or not (name.endswith(".db") or name.endswith(".db.gz")):
+            continue
+        path = os.path.join(backup_dir, name)
+        st = os.stat(path)
+        items.append({
+            "name": name,
+            "size": st.st_size,
+            "created_at": datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds"),
+        })
+    # il nome contiene il timestamp: ordinamento lessicografico = cronologico
+    items.sort(key=lambda b: b["name"], reverse=True)
+    return items
+
+
+def rotate_backups(keep: int) -> List[str]:
+    """Tiene i `keep` backup più recenti; keep <= 0 li tiene tutti (come SNAPSHOT_KEEP)."""
+    removed: List[str] = []
+    if keep <= 0:
+        return removed
+    for b in list_backups()[keep:]:
+        os.remove(os.path.join(site_backup_dir(), b["name"]))
+        removed.append(b["name"])
+    return removed
+
+
+class BackupRestarting(Exception):
+    """La copia a step è ripartita da capo troppe volte per le scritture concorrenti."""
+
+
+def backup_base_name(backup_dir: str) -> str:
+    # microsecondi nel nome: due backup nello stesso secondo non si sovrascrivono
+    while True:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        base_name = f"{BACKUP_PREFIX}{stamp}.db"
+        if not any(os.path.exists(os.path.join(backup_dir, n)) for n in (base_name, base_name + ".gz")):
+            return base_name
+
+
+def backup_db(compress: Optional[bool] = None, keep: Optional[int] = None) -> str:
+    """
+    Copia consistente di inventory.db a caldo con Connection.backup.
+    La copia avanza a blocchi di BACKUP_PAGES_PER_STEP pagine con una breve pausa
+    tra uno step e l'altro, così le scansioni possono scrivere nel frattempo.
+    Ogni scrittura di un'altra connessione fa ripartire la copia da capo: dopo
+    BACKUP_MAX_RESTARTS ripartenze si ripiega su VACUUM INTO, che copia tutto in
+    un'unica transazione di lettura (in WAL non blocca le scansioni).
+    """
+    compress = BACKUP_COMPRESS if compress is None else compress
+    keep = BACKUP_KEEP if keep is None else keep
+    backup_dir = site_backup_dir()
+    ensure_dir(backup_dir)
+
+    with _backup_lock:
+        base_name = backup_base_name(backup_dir)
+        tmp_path = os.path.join(backup_dir, f".{base_name}.tmp")
+        restarts = 0
+        last_remaining = None
+
+        def _progress(status: int, remaining: int, total: int) -> None:
+            nonlocal restarts, last_remaining
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1
+                if restarts > BACKUP_MAX_RESTARTS:
+                    raise BackupRestarting()
+            last_remaining = remaining
+            if remaining and BACKUP_STEP_SLEEP > 0:
+                time.sleep(BACKUP_STEP_SLEEP)
+
+        src = connect()
+        try:
+            dst = sqlite3.connect(tmp_path)
+            try:
+                src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=_progress)
+            except BackupRestarting:
+                dst.close()
+                os.remove(tmp_path)
+                app.logger.warning("Backup ripartito %d volte, uso VACUUM INTO", restarts)
+                src.execute("VACUUM INTO ?", (tmp_path,))
+                dst = sqlite3.connect(tmp_path)
+            try:
+                # la copia resta un singolo file autonomo
+                dst.execute("PRAGMA journal_mode=DELETE;")
+            finally:
+                dst.close()
+        finally:
+            src.close()
+
+        if compress:
+            final_path = os.path.join(backup_dir, base_name + ".gz")
+            gz_tmp = tmp_path + ".gz"
+            with open(tmp_path, "rb") as fin, gzip.open(gz_tmp, "wb", compresslevel=6) as fout:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+            os.remove(tmp_path)
+            os.replace(gz_tmp, final_path)
+        else:
+            final_path = os.path.join(backup_dir, base_name)
+            os.replace(tmp_path, final_path)
+
+        rotate_backups(keep)
+    return final_path
+
+
+def start_periodic_job(name: str, interval_hours: float, job: Callable[[], Any]) -> Optional[threading.Thread]:
+    if interval_hours <= 0:
+        return None
+
+    def _loop() -> None:
+        while True:
+            time.sleep(interval_hours * 3600)
+            try:
+                job()
+            except Exception as exc:  # il thread non deve morire per un job fallito
+                app.logger.error("Job %s fallito: %s", name, exc)
+
+    t = threading.Thread(target=_loop, name=name, daemon=True)
+    t.start()
+    return t
+
+
+def start_schedulers() -> None:
+    start_periodic_job("backup-scheduler", BACKUP_INTERVAL_HOURS, lambda: for_each_site(backup_db))
+    start_periodic_job("snapshot-scheduler", SNAPSHOT_INTERVAL_HOURS, lambda: for_each_site(take_state_snapshot))
+    if alerts_enabled():
+        start_periodic_job("alert-aging", NOTIFY_AGING_INTERVAL_HOURS, lambda: for_each_site(alert_aging_pass))
+        # riprende anche le notifiche rimaste in coda da un processo precedente
+        alert_dispatcher().start()
+
+
+SCHEDULER_LOCK_PATH = DB_PATH + ".scheduler.lock"
+_scheduler_lock_fd: Optional[int] = None
+
+
+def run_schedulers_when_elected(lock_path: str = SCHEDULER_LOCK_PATH) -> None:
+    """
+    Elezione tra i worker gunicorn: gli scheduler girano solo nel worker che tiene il flock
+    esclusivo su `lock_path`. Gli altri restano in attesa sul lock; quando il worker eletto
+    esce (crash, max-requests, reload) il sistema operativo lo rilascia e ne subentra un altro.
+    """
+    import fcntl
+
+    global _scheduler_lock_fd
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    # il descrittore resta aperto per tutta la vita del processo: chiuderlo rilascerebbe il lock
+    _scheduler_lock_fd = fd
+    os.ftruncate(fd, 0)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    app.logger.info("Scheduler attivi nel worker %s", os.getpid())
+    start_schedulers()
+
+
+@app.cli.command("backup")
+@site_option
+def backup_command(site: str) -> None:
+    """Esegue un backup online di inventory.db."""
+    with use_site(site):
+        init_db()
+        path = backup_db()
+    print(path)
+
+
+# ---------------------------
+# Import massivo (CSV / XLSX)
+# ---------------------------
+IMPORT_COLUMN_ALIASES = {
+    "sku": "sku",
+    "codice": "sku",
+    "name": "name",
+    "nome": "name",
+}
+
+
+def read_import_rows(filename: str, payload: bytes) -> List[Dict[str, Any]]:
+    """
+    Legge un file CSV (anche esportato da Excel: BOM, separatore ; o tab) o XLSX.
+    Restituisce le righe come dict con intestazioni normalizzate (sku, name);
+    "_line" è il numero di riga nel file, da usare nei messaggi di errore.
+    """
+    if filename.lower().endswith(".xlsx"):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError("Per importare file XLSX installa openpyxl, oppure salva il foglio come CSV.")
+        try:
+            ws = load_workbook(io.BytesIO(payload), read_only=True, data_only=True).active
+            table = [["" if v is None else str(v) for v in row] for row in ws.iter_rows(values_only=True)]
+        except Exception as exc:
+            # file non xlsx o corrotto: openpyxl solleva BadZipFile, InvalidFileException,
+            # KeyError o errori XML a seconda del punto in cui si rompe
+            raise ValueError(f"il file non è un XLSX valido ({exc.__class__.__name__}).") from exc
+    else:
+        try:
+            text = payload.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            text = payload.decode("cp1252")
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        table = list(csv.reader(io.StringIO(text), dialect))
+
+    if not table:
+        return []
+    header = [IMPORT_COLUMN_ALIASES.get(h.strip().lower(), h.strip().lower()) for h in table[0]]
+    rows: List[Dict[str, Any]] = []
+    for line_no, raw in enumerate(table[1:], start=2):
+        if not any(cell.strip() for cell in raw):
+            continue
+        row: Dict[str, Any] = {header[i]: raw[i].strip() for i in range(min(len(header), len(raw)))}
+        row["_line"] = line_no
+        rows.append(row)
+    return rows
+
+
+def import_swabs(con: sqlite3.Connection, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Valida tutte le righe, poi inserisce tamponi e swab_state con executemany
+    in un'unica transazione. Se c'è anche un solo errore non inserisce nulla.
+    Le etichette vengono renderizzate dopo, in background.
+    """
+    errors: List[str] = []
+    duplicates: List[str] = []
+    seen: Dict[str, int] = {}
+    to_insert: List[Tuple[str, str]] = []
+    for row in rows:
+        line_no = row["_line"]
+        sku = row.get("sku", "")
+        name = row.get("name", "")
+        if not sku or not name:
+            errors.append(f"Riga {line_no}: SKU e Nome sono obbligatori.")
+            continue
+        if sku in seen:
+            duplicates.append(f"{sku} (righe {seen[sku]} e {line_no})")
+            continue
+        seen[sku] = line_no
+        to_insert.append((sku, name))
+
+    existing = set()
+    skus = [sku for sku, _ in to_insert]
+    for i in range(0, len(skus), 500):
+        chunk = skus[i:i + 500]
+        existing.update(
+            r["sku"] for r in con.execute(
+                f"SELECT sku FROM swabs WHERE sku IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+        )
+    duplicates.extend(f"{sku} (già presente)" for sku in skus if sku in existing)
+
+    if errors or duplicates or not to_insert:
+        return {"inserted": 0, "errors": errors, "duplicates": duplicates}
+
+    ts = now_iso()
+    con.executemany(
+        "INSERT INTO swabs (sku, name, created_at) VALUES (?, ?, ?)",
+        [(sku, name, ts) for sku, name in to_insert],
+    )
+    con.executemany(
+        "INSERT INTO swab_state (swab_id, in_stock, machine_id, updated_at) "
+        "SELECT id, 1, NULL, ? FROM swabs WHERE sku=?",
+        [(ts, sku) for sku in skus],
+    )
+    return {"inserted": len(to_insert), "errors": [], "duplicates": []}
+
+
+def import_machines(con: sqlite3.Connection, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    errors: List[str] = []
+    duplicates: List[str] = []
+    seen = set()
+    names: List[str] = []
+    for row in rows:
+        line_no = row["_line"]
+        name = row.get("name", "")
+        if not name:
+            errors.append(f"Riga {line_no}: Nome macchina obbligatorio.")
+            continue
+        if name in seen:
+            duplicates.append(f"{name} (riga {line_no})")
+            continue
+        seen.add(name)
+        names.append(name)
+
+    existing = {r["name"] for r in con.execute("SELECT name FROM machines")}
+    duplicates.extend(f"{name} (già presente)" for name in names if name in existing)
+
+    if errors or duplicates or not names:
+        return {"inserted": 0, "errors": errors, "duplicates": duplicates}
+
+    con.executemany("INSERT INTO machines (name) VALUES (?)", [(name,) for name in names])
+    return {"inserted": len(names), "errors": [], "duplicates": []}
+
+
+# ---------------------------
+# Operazioni massive sullo stato
+# ---------------------------
+def create_bulk_targets(con: sqlite3.Connection) -> None:
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_targets (swab_id INTEGER PRIMARY KEY)")
+    con.execute("DELETE FROM temp.bulk_targets")
+
+
+def drop_bulk_targets(con: sqlite3.Connection) -> None:
+    con.execute("DROP TABLE IF EXISTS temp.bulk_targets")
+
+
+def bulk_return(con: sqlite3.Connection, ts: str, note: Optional[str] = None) -> int:
+    """
+    RESO di tutti i tamponi in temp.bulk_targets con SQL set-based:
+    movimenti, chiusura sessioni, giorni unici e stato in poche istruzioni.
+    Stessa regola di add_usage_days_for_range: stesso giorno e <= 2 ore => 0 giorni.
+    """
+    n = con.execute(
+        "INSERT INTO movements (swab_id, action, machine_id, ts, note) "
+        "SELECT swab_id, 'RETURN', NULL, ?, ? FROM temp.bulk_targets",
+        (ts, note),
+    ).rowcount
+    con.execute(
+        """
+        WITH RECURSIVE
+          sess(swab_id, d, last) AS (
+            SELECT us.swab_id, date(us.taken_ts), date(:ts)
+            FROM usage_sessions us
+            JOIN temp.bulk_targets t ON t.swab_id = us.swab_id
+            WHERE us.returned_ts IS NULL
+              AND NOT (date(us.taken_ts) = date(:ts)
+                       AND CAST(round((julianday(:ts) - julianday(us.taken_ts)) * 86400) AS INTEGER) <= 7200)
+          ),
+          days(swab_id, d, last) AS (
+            SELECT swab_id, d, last FROM sess
+            UNION ALL
+            SELECT swab_id, date(d, '+1 day'), last FROM days WHERE d < last
+          )
+        INSERT OR IGNORE INTO usage_days (swab_id, day)
+        SELECT swab_id, d FROM days
+        """,
+        {"ts": ts},
+    )
+    con.execute(
+        "UPDATE usage_sessions SET returned_ts=? "
+        "WHERE returned_ts IS NULL AND swab_id IN (SELECT swab_id FROM temp.bulk_targets)",
+        (ts,),
+    )
+    con.execute(
+        "INSERT OR REPLACE INTO swab_state (swab_id, in_stock, machine_id, updated_at) "
+        "SELECT swab_id, 1, NULL, ? FROM temp.bulk_targets",
+        (ts,),
+    )
+    return n
+
+
+def bulk_move(con: sqlite3.Connection, to_machine_id: int, ts: str, note: Optional[str] = None) -> int:
+    """
+    Sposta su un'altra macchina i tamponi in temp.bulk_targets: come un TAKE su un
+    tampone già PRESO la sessione d'uso resta aperta, cambia solo la macchina.
+    """
+    n = con.execute(
+        "INSERT INTO movements (swab_id, action, machine_id, ts, note) "
+        "SELECT swab_id, 'TAKE', ?, ?, ? FROM temp.bulk_targets",
+        (to_machine_id, ts, note),
+    ).rowcount
+    con.execute(
+        "UPDATE swab_state SET machine_id=?, updated_at=? "
+        "WHERE swab_id IN (SELECT swab_id FROM temp.bulk_targets)",
+        (to_machine_id, ts),
+    )
+    return n
+
+
+def bulk_target_skus(con: sqlite3.Connection) -> List[str]:
+    return [
+        r["sku"] for r in con.execute(
+            "SELECT s.sku FROM swabs s JOIN temp.bulk_targets t ON t.swab_id = s.id ORDER BY s.sku"
+        )
+    ]
+
+
+# ---------------------------
+# Snapshot e interrogazioni storiche
+# ---------------------------
+def take_state_snapshot(keep: Optional[int] = None) -> int:
+    """
+    Fotografa swab_state, sessione aperta e contatori giorni di tutti i tamponi,
+    poi tiene solo gli ultimi `keep` snapshot (una riga per tampone ciascuno).
+    """
+    keep = SNAPSHOT_KEEP if keep is None else keep
+    with connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        row = con.execute("SELECT COALESCE(MAX(id), 0) AS m FROM movements").fetchone()
+        cur = con.execute(
+            "INSERT INTO state_snapshots (taken_at, last_movement_id) VALUES (?, ?)",
+            (now_iso(), int(row["m"])),
+        )
+        snapshot_id = int(cur.lastrowid)
+        con.execute(
+            """
+            INSERT INTO state_snapshot_rows
+              (snapshot_id, swab_id, in_stock, machine_id, open_taken_ts, total_days, last_day)
+            SELECT ?, s.id,
+                   COALESCE(st.in_stock, 1),
+                   st.machine_id,
+                   (SELECT us.taken_ts FROM usage_sessions us
+                     WHERE us.swab_id = s.id AND us.returned_ts IS NULL
+                     ORDER BY us.taken_epoch DESC LIMIT 1),
+                   (SELECT COUNT(*) FROM usage_days ud WHERE ud.swab_id = s.id),
+                   (SELECT MAX(ud.day) FROM usage_days ud WHERE ud.swab_id = s.id)
+            FROM swabs s
+            LEFT JOIN swab_state st ON st.swab_id = s.id
+            """,
+            (snapshot_id,),
+        )
+        prune_state_snapshots(con, keep)
+        con.commit()
+    return snapshot_id
+
+
+def prune_state_snapshots(con: sqlite3.Connection, keep: int) -> int:
+    """
+    Elimina gli snapshot oltre gli ultimi `keep` (le righe seguono per ON DELETE CASCADE).
+    Le date più vecchie dello snapshot più vecchio rigiocano i movimenti dall'inizio.
+    """
+    if keep <= 0:
+        return 0
+    cur = con.execute(
+        "DELETE FROM state_snapshots WHERE id NOT IN "
+        "(SELECT id FROM state_snapshots ORDER BY taken_at DESC, id DESC LIMIT ?)",
+        (keep,),
+    )
+    return cur.rowcount
+
+
+def parse_at_param(raw: str) -> str:
+    """
+    Accetta un timestamp ISO; una data senza ora vale come fine giornata.
+    Un orario con fuso (…Z, …+02:00) viene convertito nell'ora locale, come i ts salvati.
+    """
+    raw = raw.strip()
+    dt = parse_iso(raw)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    if len(raw) == 10:
+        dt = dt.replace(hour=23, minute=59, second=59)
+    return dt.isoformat(timespec="seconds")
+
+
+def inventory_at(con: sqlite3.Connection, at_iso: str) -> Dict[str, Any]:
+    """
+    Stato dell'inventario al tempo `at_iso`: parte dallo snapshot più recente
+    non successivo e rigioca solo i movimenti registrati dopo di esso, con le
+    stesse regole di /api/scan (sessione aperta al primo TAKE, giorni unici al RETURN).
+    """
+    snap = con.execute(
+        "SELECT id, taken_at, last_movement_id FROM state_snapshots "
+        "WHERE taken_at <= ? ORDER BY taken_at DESC, id DESC LIMIT 1",
+        (at_iso,),
+    ).fetchone()
+
+    # giorni e timestamp come interi (epoch): nessun parse ISO per movimento
+    at_epoch = iso_to_epoch(at_iso)
+    state: Dict[int, Dict[str, Any]] = {}
+    last_movement_id = 0
+    if snap:
+        last_movement_id = int(snap["last_movement_id"])
+        for r in con.execute(
+            "SELECT swab_id, in_stock, machine_id, open_taken_ts, total_days, last_day "
+            "FROM state_snapshot_rows WHERE snapshot_id=?",
+            (int(snap["id"]),),
+        ):
+            state[int(r["swab_id"])] = {
+                "in_stock": int(r["in_stock"]),
+                "machine_id": r["machine_id"],
+                "open_taken_ts": r["open_taken_ts"],
+                "open_taken_epoch": iso_to_epoch(r["open_taken_ts"]) if r["open_taken_ts"] else None,
+                "total_days": int(r["total_days"]),
+                "last_day": iso_to_epoch(r["last_day"]) // DAY_SECONDS if r["last_day"] else None,
+            }
+
+    replayed = 0
+    for mv in con.execute(
+        "SELECT swab_id, action, machine_id, ts, ts_epoch FROM movements WHERE id > ? AND ts_epoch <= ? ORDER BY id",
+        (last_movement_id, at_epoch),
+    ):
+        replayed += 1
+        st = state.setdefault(int(mv["swab_id"]), {
+            "in_stock": 1, "machine_id": None, "open_taken_ts": None, "open_taken_epoch": None,
+            "total_days": 0, "last_day": None,
+        })
+        if mv["action"] == "TAKE":
+            if not st["open_taken_ts"]:
+                st["open_taken_ts"] = mv["ts"]
+                st["open_taken_epoch"] = mv["ts_epoch"]
+            st["in_stock"] = 0
+            st["machine_id"] = mv["machine_id"]
+            continue
+
+        if st["open_taken_ts"] and calendar_days_between_epoch(st["open_taken_epoch"], mv["ts_epoch"]) > 0:
+            first = st["open_taken_epoch"] // DAY_SECONDS
+            last = mv["ts_epoch"] // DAY_SECONDS
+            if st["last_day"] is not None and st["last_day"] >= first:
+                first = st["last_day"] + 1
+            if last >= first:
+                st["total_days"] += last - first + 1
+                st["last_day"] = last
+        st["open_taken_ts"] = None
+        st["open_taken_epoch"] = None
+        st["in_stock"] = 1
+        st["machine_id"] = None
+
+    machines = {m["id"]: m["name"] for m in list_machines(con)}
+    swabs_out: List[Dict[str, Any]] = []
+    for r in con.execute(
+        "SELECT id, sku, name FROM swabs WHERE created_at <= ? ORDER BY name COLLATE NOCASE",
+        (at_iso,),
+    ):
+        st = state.get(int(r["id"])) or {
+            "in_stock": 1, "machine_id": None, "open_taken_ts": None, "open_taken_epoch": None, "total_days": 0,
+        }
+        mid = st["machine_id"] if st["in_stock"] == 0 else None
+        ot = st["open_taken_ts"]
+        swabs_out.append({
+            "id": int(r["id"]),
+            "sku": r["sku"],
+            "name": r["name"],
+            "in_stock": bool(st["in_stock"]),
+            "machine_id": mid,
+            "machine_name": machines.get(mid) if mid else None,
+            "open_taken_ts": ot,
+            "current_days": calendar_days_between_epoch(st["open_taken_epoch"], at_epoch) if ot else 0,
+            "total_days": st["total_days"],
+        })
+
+    return {
+        "at": at_iso,
+        "snapshot": {"id": int(snap["id"]), "taken_at": snap["taken_at"]} if snap else None,
+        "replayed_movements": replayed,
+        "swabs": swabs_out,
+    }
+
+
+@app.cli.command("snapshot")
+@site_option
+def snapshot_command(site: str) -> None:
+    """Registra uno snapshot dello stato corrente (per le interrogazioni storiche)."""
+    with use_site(site):
+        init_db()
+        print(take_state_snapshot())
+
+
+# ---------------------------
+# Ricostruzione tabelle derivate
+# ---------------------------
+def replay_swab(movements: List[Tuple[str, Optional[int], str]]) -> Dict[str, Any]:
+    """
+    Rigioca i movimenti (action, machine_id, ts) di un tampone con le regole
+    di /api/scan e restituisce sessioni, giorni unici e stato finale.
+    """
+    sessions: List[List[Optional[str]]] = []
+    days: Dict[str, None] = {}
+    open_sess: Optional[List[Optional[str]]] = None
+    in_stock, machine_id, updated_at = 1, None, None
+    for action, mid, ts in movements:
+        updated_at = ts
+        if action == "TAKE":
+            if open_sess is None:
+                open_sess = [ts, None]
+                sessions.append(open_sess)
+            in_stock, machine_id = 0, mid
+        else:
+            if open_sess is not None:
+                open_sess[1] = ts
+                days.update(dict.fromkeys(usage_day_keys(open_sess[0], ts)))
+                open_sess = None
+            in_stock, machine_id = 1, None
+    return {
+        "sessions": [(a, b) for a, b in sessions],
+        "days": list(days),
+        "state": (in_stock, machine_id, updated_at),
+    }
+
+
+def _replay_shard(db_path: str, shard: int, shards: int) -> Dict[int, Dict[str, Any]]:
+    # gira in un processo separato: connessione propria, solo lettura
+    con = sqlite3.connect(readonly_uri(db_path), uri=True)
+    try:
+        out: Dict[int, Dict[str, Any]] = {}
+        current_id: Optional[int] = None
+        buf: List[Tuple[str, Optional[int], str]] = []
+        cur = con.execute(
+            "SELECT swab_id, action, machine_id, ts FROM movements "
+            "WHERE swab_id % ? = ? ORDER BY swab_id, id",
+            (shards, shard),
+        )
+        for swab_id, action, mid, ts in cur:
+            if swab_id != current_id:
+                if current_id is not None:
+                    out[current_id] = replay_swab(buf)
+                current_id, buf = swab_id, []
+            buf.append((action, mid, ts))
+        if current_id is not None:
+            out[current_id] = replay_swab(buf)
+        return out
+    finally:
+        con.close()
+
+
+def load_derived_tables(con: sqlite3.Connection) -> Dict[int, Dict[str, Any]]:
+    current: Dict[int, Dict[str, Any]] = {}
+
+    def _get(swab_id: int) -> Dict[str, Any]:
+        return current.setdefault(swab_id, {"sessions": [], "days": [], "state": (1, None, None)})
+
+    for r in con.execute("SELECT swab_id, taken_ts, returned_ts FROM usage_sessions ORDER BY swab_id, taken_ts, id"):
+        _get(int(r["swab_id"]))["sessions"].append((r["taken_ts"], r["returned_ts"]))
+    for r in con.execute("SELECT swab_id, day FROM usage_days ORDER BY swab_id, day"):
+        _get(int(r["swab_id"]))["days"].append(r["day"])
+    for r in con.execute("SELECT swab_id, in_stock, machine_id, updated_at FROM swab_state"):
+        _get(int(r["swab_id"]))["state"] = (int(r["in_stock"]), r["machine_id"], r["updated_at"])
+    return current
+
+
+def replay_all_movements(workers: int) -> Dict[int, Dict[str, Any]]:
+    rebuilt: Dict[int, Dict[str, Any]] = {}
+    if workers == 1:
+        rebuilt.update(_replay_shard(site_db_path(), 0, 1))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_replay_shard, site_db_path(), i, workers) for i in range(workers)]
+            for f in futures:
+                rebuilt.update(f.result())
+    return rebuilt
+
+
+REBUILD_ATTEMPTS = 3
+
+
+def rebuild_derived_tables(workers: int = 0, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Ricalcola usage_sessions, usage_days e swab_state dal log movements.
+    Il replay è suddiviso per swab_id su più processi e gira senza lock, così le
+    scansioni continuano; la scrittura avviene in blocco in un'unica transazione
+    solo se data_version non è cambiata dall'inizio del replay, altrimenti si
+    rigioca da capo (fino a REBUILD_ATTEMPTS volte). Con dry_run restituisce solo le differenze.
+    """
+    workers = workers or min(8, os.cpu_count() or 1)
+    for _ in range(REBUILD_ATTEMPTS):
+        with connect() as con:
+            version = data_version(con)
+        rebuilt = replay_all_movements(workers)
+
+        with connect() as con:
+            swabs = {int(r["id"]): (r["sku"], r["created_at"]) for r in con.execute("SELECT id, sku, created_at FROM swabs")}
+            for swab_id, (_, created_at) in swabs.items():
+                res = rebuilt.setdefault(swab_id, {"sessions": [], "days": [], "state": (1, None, None)})
+                if res["state"][2] is None:
+                    res["state"] = (1, None, created_at)
+
+            current = load_derived_tables(con)
+            diffs: List[Dict[str, Any]] = []
+            for swab_id, (sku, _) in sorted(swabs.items()):
+                new = rebuilt[swab_id]
+                old = current.get(swab_id, {"sessions": [], "days": [], "state": (1, None, None)})
+                problems: List[str] = []
+                if sorted(old["sessions"], key=lambda x: (x[0], x[1] or "")) != sorted(new["sessions"], key=lambda x: (x[0], x[1] or "")):
+                    problems.append(f"sessioni {len(old['sessions'])} -> {len(new['sessions'])}")
+                if sorted(old["days"]) != sorted(new["days"]):
+                    problems.append(f"giorni {len(old['days'])} -> {len(new['days'])}")
+                if old["state"][:2] != new["state"][:2]:
+                    problems.append(f"stato {old['state'][:2]} -> {new['state'][:2]}")
+                if problems:
+                    diffs.append({"swab_id": swab_id, "sku": sku, "changes": problems})
+
+            summary = {
+                "swabs": len(swabs),
+                "sessions": sum(len(r["sessions"]) for sid, r in rebuilt.items() if sid in swabs),
+                "days": sum(len(r["days"]) for sid, r in rebuilt.items() if sid in swabs),
+                "diffs": diffs,
+                "dry_run": dry_run,
+            }
+            if dry_run or not diffs:
+                return summary
+
+            con.execute("BEGIN IMMEDIATE")
+            if data_version(con) != version:
+                # una scansione è stata registrata durante il replay: il risultato è già vecchio
+                con.rollback()
+                continue
+            con.execute("DELETE FROM usage_days")
+            con.execute("DELETE FROM usage_sessions")
+            con.executemany(
+                "INSERT INTO usage_sessions (swab_id, taken_ts, returned_ts) VALUES (?, ?, ?)",
+                ((sid, a, b) for sid, r in rebuilt.items() if sid in swabs for a, b in r["sessions"]),
+            )
+            con.executemany(
+                "INSERT INTO usage_days (swab_id, day) VALUES (?, ?)",
+                ((sid, d) for sid, r in rebuilt.items() if sid in swabs for d in r["days"]),
+            )
+            con.executemany(
+                "INSERT OR REPLACE INTO swab_state (swab_id, in_stock, machine_id, updated_at) VALUES (?, ?, ?, ?)",
+                ((sid, *r["state"]) for sid, r in rebuilt.items() if sid in swabs),
+            )
+            # gli snapshot erano fotografie delle tabelle non corrette
+            con.execute("DELETE FROM state_snapshots")
+            # nuova generazione: previsioni e schede tampone in cache (in tutti i worker) vanno ricalcolate
+            bump_generation(con, SETTINGS_KEY_DERIVED_GENERATION)
+            con.commit()
+        take_state_snapshot()
+        return summary
+    raise RuntimeError(
+        f"Il log movimenti è cambiato durante ognuno dei {REBUILD_ATTEMPTS} tentativi: "
+        "riprova in un momento con meno scansioni."
+    )
+
+
+@app.cli.command("rebuild-derived")
+@click.option("--dry-run", is_flag=True, help="Mostra solo le differenze, senza scrivere.")
+@click.option("--workers", default=0, type=int, help="Processi per il replay (0 = automatico).")
+@site_option
+def rebuild_derived_command(dry_run: bool, workers: int, site: str) -> None:
+    """Ricostruisce usage_sessions, usage_days e swab_state dal log movements."""
+    started = time.perf_counter()
+    with use_site(site):
+        init_db()
+        try:
+            summary = rebuild_derived_tables(workers=workers, dry_run=dry_run)
+        except RuntimeError as exc:
+            raise click.ClickException(str(exc))
+    for d in summary["diffs"]:
+        print(f"{d['sku']} (id {d['swab_id']}): {', '.join(d['changes'])}")
+    print(
+        f"{summary['swabs']} tamponi, {summary['sessions']} sessioni, {summary['days']} giorni; "
+        f"{len(summary['diffs'])} tamponi con differenze; "
+        f"{'dry-run, nessuna scrittura' if dry_run else 'tabelle aggiornate' if summary['diffs'] else 'nessuna modifica'} "
+        f"({time.perf_counter() - started:.1f}s)"
+    )
+
+
+# ---------------------------
+# Previsione soglie avviso/allarme
+# ---------------------------
+_forecast_cache_lock = threading.Lock()
+_forecast_cache: Dict[str, Dict[str, Any]] = {}
+
+
+def bump_generation(con: sqlite3.Connection, key: str) -> None:
+    """Incrementa un contatore in settings: le cache di tutti i worker vedono una nuova data_version."""
+    con.execute(
+        "INSERT INTO settings (key, value) VALUES (?, '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+        (key,),
+    )
+
+
+def data_version(con: sqlite3.Connection) -> Tuple[int, int, int, int]:
+    """
+    Cambia a ogni scansione/movimento, a ogni aggiunta, modifica o eliminazione
+    di tamponi e a ogni rebuild-derived che riscrive le tabelle derivate.
+    """
+    row = con.execute(
+        "SELECT (SELECT COALESCE(MAX(id), 0) FROM movements) AS mv, "
+        "(SELECT COALESCE(MAX(id), 0) + COUNT(*) FROM swabs) AS sw, "
+        "(SELECT COALESCE(CAST(value AS INTEGER), 0) FROM settings WHERE key = ?) AS gen, "
+        "(SELECT COALESCE(CAST(value AS INTEGER), 0) FROM settings WHERE key = ?) AS cat",
+        (SETTINGS_KEY_DERIVED_GENERATION, SETTINGS_KEY_CATALOG_GENERATION),
+    ).fetchone()
+    return int(row["mv"]), int(row["sw"]), int(row["gen"] or 0), int(row["cat"] or 0)
+
+
+def _days_until(threshold: int, value: int, rate: float) -> Optional[int]:
+    # soglia superata quando value > threshold (stessa regola di iter_swabs)
+    need = threshold + 1 - value
+    if need <= 0:
+        return 0
+    if rate <= 0:
+        return None
+    return int(math.ceil(need / rate))
+
+
+def compute_forecast(con: sqlite3.Connection) -> List[Dict[str, Any]]:
+    """
+    Carica in una sola query aggregata lo storico d'uso di tutti i tamponi
+    (giorni totali, giorni nella finestra recente, sessione aperta) e stima
+    per ciascuno il ritmo d'uso e la data prevista di superamento delle soglie.
+    """
+    warn_days = get_global_warn_days(con)
+    alarm_days = get_global_alarm_days(con)
+    now = now_epoch()
+    today = now // DAY_SECONDS
+    window_start = today - (FORECAST_WINDOW_DAYS - 1)
+
+    rows = con.execute(
+        """
+        WITH tot AS (
+            SELECT swab_id, COUNT(*) AS n, MAX(day_num) AS last_day,
+                   SUM(CASE WHEN day_num >= :window_start THEN 1 ELSE 0 END) AS recent
+            FROM usage_days GROUP BY swab_id
+        ),
+        open_sess AS (
+            SELECT swab_id, MAX(taken_epoch) AS taken_epoch
+            FROM usage_sessions WHERE returned_ts IS NULL GROUP BY swab_id
+        )
+        SELECT s.id, s.sku, s.name,
+               COALESCE(st.in_stock, 1) AS in_stock,
+               mc.name AS machine_name,
+               COALESCE(tot.n, 0) AS total_days,
+               COALESCE(tot.recent, 0) AS recent_days,
+               tot.last_day,
+               open_sess.taken_epoch AS open_taken_epoch
+        FROM swabs s
+        LEFT JOIN swab_state st ON st.swab_id = s.id
+        LEFT JOIN machines mc ON mc.id = st.machine_id
+        LEFT JOIN tot ON tot.swab_id = s.id
+        LEFT JOIN open_sess ON open_sess.swab_id = s.id
+        """,
+        {"window_start": window_start},
+    ).fetchall()
+
+    return [
+        {
+            "id": int(r["id"]),
+            "sku": r["sku"],
+            "name": r["name"],
+            "in_stock": int(r["in_stock"]),
+            "machine_name": r["machine_name"],
+            **forecast_swab(
+                int(r["total_days"]), int(r["recent_days"]), r["last_day"], r["open_taken_epoch"],
+                now, warn_days, alarm_days,
+            ),
+        }
+        for r in rows
+    ]
+
+
+def forecast_swab(total_days: int, recent_days: int, last_day: Optional[int], open_taken: Optional[int],
+                  now: int, warn_days: int, alarm_days: int) -> Dict[str, Any]:
+    """
+    Ritmo d'uso e giorni mancanti alle soglie di un tampone. `last_day` è l'ultimo
+    giorno registrato (epoch-day), `open_taken` l'inizio della sessione aperta (epoch).
+    """
+    today = now // DAY_SECONDS
+    window_start = today - (FORECAST_WINDOW_DAYS - 1)
+    current_days = calendar_days_between_epoch(open_taken, now) if open_taken is not None else 0
+
+    # giorni della sessione aperta non ancora registrati in usage_days
+    open_uncounted = open_recent = 0
+    if open_taken is not None and current_days > 0:
+        first = open_taken // DAY_SECONDS
+        if last_day is not None:
+            first = max(first, last_day + 1)
+        if first <= today:
+            open_uncounted = today - first + 1
+            open_recent = today - max(first, window_start) + 1
+
+    effective_total = total_days + open_uncounted
+    # se è in uso ora, entrambi i contatori crescono di un giorno al giorno
+    rate = 1.0 if open_taken is not None else (recent_days + open_recent) / FORECAST_WINDOW_DAYS
+
+    def _crossing(threshold: int) -> Optional[int]:
+        candidates = [_days_until(threshold, effective_total, rate)]
+        if open_taken is not None:
+            candidates.append(_days_until(threshold, current_days, 1.0))
+        known = [c for c in candidates if c is not None]
+        return min(known) if known else None
+
+    to_warn = _crossing(warn_days)
+    to_alarm = _crossing(alarm_days)
+    return {
+        "total_days": effective_total,
+        "current_days": current_days,
+        "rate_per_week": round(rate * 7, 2),
+        "days_to_warn": to_warn,
+        "days_to_alarm": to_alarm,
+        "warn_date": epoch_day_to_key(today + to_warn) if to_warn is not None else None,
+        "alarm_date": epoch_day_to_key(today + to_alarm) if to_alarm is not None else None,
+    }
+
+
+def get_forecast(con: sqlite3.Connection) -> List[Dict[str, Any]]:
+    """Previsione in cache fino alla prossima scansione (o al cambio di giorno/soglie)."""
+    key = (
+        data_version(con),
+        now_iso()[:10],
+        get_global_warn_days(con),
+        get_global_alarm_days(con),
+    )
+    site_id = current_site_id()
+    with _forecast_cache_lock:
+        cached = _forecast_cache.get(site_id)
+        if cached and cached["key"] == key:
+            return cached["rows"]
+    rows = compute_forecast(con)
+    with _forecast_cache_lock:
+        _forecast_cache[site_id] = {"key": key, "rows": rows}
+    return rows
+
+
+def due_soon(forecast: List[Dict[str, Any]], horizon_days: int) -> List[Dict[str, Any]]:
+    due = [
+        f for f in forecast
+        if f["days_to_warn"] is not None and f["days_to_warn"] <= horizon_days
+    ]
+    due.sort(key=lambda f: (
+        f["days_to_alarm"] if f["days_to_alarm"] is not None else math.inf,
+        f["days_to_warn"],
+        f["name"].lower(),
+    ))
+    return due
+
+
+# ---------------------------
+# Scheda tampone (timeline)
+# ---------------------------
+_timeline_cache_lock = threading.Lock()
+_timeline_cache: "OrderedDict[Tuple[str, int], Dict[str, Any]]" = OrderedDict()
+
+
+def compute_swab_timeline(con: sqlite3.Connection, swab_id: int) -> Dict[str, Any]:
+    """
+    Parte della scheda che dipende solo dai dati: movimenti, sessioni,
+    permanenze per macchina e giorni unici. Tre query sugli indici per tampone.
+    """
+    movements = [
+        {"ts": r["ts"], "epoch": r["ts_epoch"], "action": r["action"], "machine_id": r["machine_id"]}
+        for r in con.execute(
+            "SELECT ts, ts_epoch, action, machine_id FROM movements "
+            "WHERE swab_id=? ORDER BY ts_epoch, id",
+            (swab_id,),
+        )
+    ]
+    sessions = [
+        {
+            "taken_ts": r["taken_ts"],
+            "returned_ts": r["returned_ts"],
+            "taken_epoch": r["taken_epoch"],
+            "returned_epoch": r["returned_epoch"],
+            "days": calendar_days_between_epoch(r["taken_epoch"], r["returned_epoch"])
+            if r["returned_epoch"] is not None else None,
+        }
+        for r in con.execute(
+            "SELECT taken_ts, returned_ts, taken_epoch, returned_epoch FROM usage_sessions "
+            "WHERE swab_id=? ORDER BY taken_epoch, id",
+            (swab_id,),
+        )
+    ]
+    days = [
+        (r["day"], int(r["day_num"]))
+        for r in con.execute("SELECT day, day_num FROM usage_days WHERE swab_id=? ORDER BY day_num", (swab_id,))
+    ]
+
+    # permanenze: un TAKE apre (o sposta) l'assegnazione, il RETURN la chiude
+    assignments: List[Dict[str, Any]] = []
+    current: Optional[Dict[str, Any]] = None
+    for mv in movements:
+        if current is not None:
+            current["until_ts"], current["until_epoch"] = mv["ts"], mv["epoch"]
+            current = None
+        if mv["action"] == "TAKE":
+            current = {
+                "machine_id": mv["machine_id"],
+                "from_ts": mv["ts"], "from_epoch": mv["epoch"],
+                "until_ts": None, "until_epoch": None,
+            }
+            assignments.append(current)
+
+    return {"movements": movements, "sessions": sessions, "assignments": assignments, "days": days}
+
+
+def get_swab_timeline(con: sqlite3.Connection, swab_id: int) -> Dict[str, Any]:
+    """compute_swab_timeline in cache per (sito, tampone) finché non cambia data_version."""
+    key = (current_site_id(), swab_id)
+    version = data_version(con)
+    with _timeline_cache_lock:
+        cached = _timeline_cache.get(key)
+        if cached and cached["version"] == version:
+            _timeline_cache.move_to_end(key)
+            return cached["data"]
+    data = compute_swab_timeline(con, swab_id)
+    with _timeline_cache_lock:
+        _timeline_cache[key] = {"version": version, "data": data}
+        _timeline_cache.move_to_end(key)
+        while len(_timeline_cache) > TIMELINE_CACHE_SIZE:
+            _timeline_cache.popitem(last=False)
+    return data
+
+
+def swab_timeline(con: sqlite3.Connection, swab_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Scheda completa di un tampone: la parte in cache più i valori che
+    dipendono dall'ora attuale (sessione aperta, giorni mancanti alle soglie).
+    """
+    sw = con.execute(
+        """
+        SELECT s.id, s.sku, s.name, s.created_at,
+               COALESCE(st.in_stock, 1) AS in_stock, st.machine_id
+        FROM swabs s LEFT JOIN swab_state st ON st.swab_id = s.id
+        WHERE s.id=?
+        """,
+        (swab_id,),
+    ).fetchone()
+    if not sw:
+        return None
+
+    data = get_swab_timeline(con, swab_id)
+    machines = {m["id"]: m["name"] for m in list_machines(con)}
+    warn_days = get_global_warn_days(con)
+    alarm_days = get_global_alarm_days(con)
+    now = now_epoch()
+
+    assignments = []
+    per_machine: Dict[Optional[int], Dict[str, Any]] = {}
+    for a in data["assignments"]:
+        seconds = (a["until_epoch"] if a["until_epoch"] is not None else now) - a["from_epoch"]
+        assignments.append({
+            "machine_id": a["machine_id"],
+            "machine_name": machines.get(a["machine_id"]),
+            "from_ts": a["from_ts"],
+            "until_ts": a["until_ts"],
+            "hours": round(seconds / 3600, 1),
+        })
+        pm = per_machine.setdefault(a["machine_id"], {
+            "machine_id": a["machine_id"],
+            "machine_name": machines.get(a["machine_id"]),
+            "seconds": 0,
+            "assignments": 0,
+        })
+        pm["seconds"] += seconds
+        pm["assignments"] += 1
+    time_per_machine = [
+        {
+            "machine_id": pm["machine_id"],
+            "machine_name": pm["machine_name"],
+            "assignments": pm["assignments"],
+            "hours": round(pm["seconds"] / 3600, 1),
+        }
+        for pm in sorted(per_machine.values(), key=lambda pm: -pm["seconds"])
+    ]
+
+    closed = [se for se in data["sessions"] if se["returned_epoch"] is not None]
+    open_sess = next((se for se in reversed(data["sessions"]) if se["returned_epoch"] is None), None)
+    open_taken = open_sess["taken_epoch"] if open_sess else None
+    avg_hours = (
+        sum(se["returned_epoch"] - se["taken_epoch"] for se in closed) / len(closed) / 3600 if closed else None
+    )
+    avg_days = sum(se["days"] for se in closed) / len(closed) if closed else None
+
+    window_start = now // DAY_SECONDS - (FORECAST_WINDOW_DAYS - 1)
+    days = data["days"]
+    forecast = forecast_swab(
+        len(days),
+        sum(1 for _, n in days if n >= window_start),
+        days[-1][1] if days else None,
+        open_taken,
+        now,
+        warn_days,
+        alarm_days,
+    )
+    current_days = forecast["current_days"]
+    recorded_days = len(days)
+
+    return {
+        "id": int(sw["id"]),
+        "sku": sw["sku"],
+        "name": sw["name"],
+        "created_at": sw["created_at"],
+        "in_stock": int(sw["in_stock"]),
+        "machine_name": machines.get(sw["machine_id"]) if int(sw["in_stock"]) == 0 else None,
+        "movements": [
+            {
+                "ts": mv["ts"],
+                "action": mv["action"],
+                "machine_name": machines.get(mv["machine_id"]) if mv["action"] == "TAKE" else None,
+            }
+            for mv in data["movements"]
+        ],
+        "sessions": [
+            {"taken_ts": se["taken_ts"], "returned_ts": se["returned_ts"], "days": se["days"]}
+            for se in data["sessions"]
+        ],
+        "assignments": assignments,
+        # accumulo dei giorni unici: un punto per giorno registrato
+        "days": [{"day": day, "total": i} for i, (day, _) in enumerate(days, start=1)],
+        "stats": {
+            "sessions": len(data["sessions"]),
+            "avg_session_hours": round(avg_hours, 1) if avg_hours is not None else None,
+            "avg_session_days": round(avg_days, 1) if avg_days is not None else None,
+            "time_per_machine": time_per_machine,
+            "total_days": recorded_days,
+            "current_days": current_days,
+            "warn_days": warn_days,
+            "alarm_days": alarm_days,
+            "warning": current_days > warn_days or recorded_days > warn_days,
+            "alarm": current_days > alarm_days or recorded_days > alarm_days,
+            "days_to_warn": forecast["days_to_warn"],
+            "days_to_alarm": forecast["days_to_alarm"],
+            "warn_date": forecast["warn_date"],
+            "alarm_date": forecast["alarm_date"],
+            "rate_per_week": forecast["rate_per_week"],
+        },
+    }
+
+
+# ---------------------------
+# Notifiche superamento soglie
+# ---------------------------
+ALERT_LEVEL_NAMES = {1: "warn", 2: "alarm"}
+ALERT_LEVEL_LABELS = {1: "AVVISO", 2: "ALLARME"}
+
+
+def alert_level(current_days: int, total_days: int, warn_days: int, alarm_days: int) -> int:
+    # stessa regola dei flag warning/alarm di /api/scan e della lista tamponi
+    if current_days > alarm_days or total_days > alarm_days:
+        return 2
+    if current_days > warn_days or total_days > warn_days:
+        return 1
+    return 0
+
+
+def check_alert_levels(con: sqlite3.Connection, source: str, where: str = "", params: Tuple[Any, ...] = ()) -> List[Dict[str, Any]]:
+    """
+    Confronta il livello attuale dei tamponi selezionati da `where` con quello già
+    notificato, aggiorna alert_levels e alert_outbox nella transazione del chiamante
+    e restituisce i superamenti nuovi. Dopo il commit basta svegliare il dispatcher.
+    """
+    if not alerts_enabled():
+        return []
+    ts = now_iso()
+    now = iso_to_epoch(ts)
+    rows = []
+    for r in con.execute(
+        f"""
+        SELECT s.id, s.sku, s.name, COALESCE(al.level, 0) AS notified,
+               (SELECT COUNT(*) FROM usage_days ud WHERE ud.swab_id = s.id) AS total_days,
+               (SELECT MAX(us.taken_epoch) FROM usage_sessions us
+                 WHERE us.swab_id = s.id AND us.returned_ts IS NULL) AS open_taken_epoch
+        FROM swabs s
+        LEFT JOIN alert_levels al ON al.swab_id = s.id
+        {where}
+        """,
+        params,
+    ):
+        ot = r["open_taken_epoch"]
+        current_days = calendar_days_between_epoch(ot, now) if ot is not None else 0
+        rows.append((int(r["id"]), r["sku"], r["name"], int(r["notified"]), current_days, int(r["total_days"])))
+    return record_alert_levels(
+        con, source, rows, get_global_warn_days(con), get_global_alarm_days(con), ts,
+    )
+
+
+def record_alert_levels(con: sqlite3.Connection, source: str, rows: Iterable[Tuple[int, str, str, int, int, int]],
+                        warn_days: int, alarm_days: int, ts: str) -> List[Dict[str, Any]]:
+    """rows: (swab_id, sku, name, livello notificato, giorni sessione, giorni totali)."""
+    site = current_site()
+    changes: List[Tuple[int, int, str]] = []
+    events: List[Dict[str, Any]] = []
+    for swab_id, sku, name, notified, current_days, total_days in rows:
+        level = alert_level(current_days, total_days, warn_days, alarm_days)
+        if level == notified:
+            continue
+        # un calo (soglie alzate, ricostruzione) si registra senza notificare
+        changes.append((swab_id, level, ts))
+        if level > notified:
+            events.append({
+                "site": site["id"],
+                "site_name": site["name"],
+                "swab_id": swab_id,
+                "sku": sku,
+                "name": name,
+                "level": ALERT_LEVEL_NAMES[level],
+                "current_days": current_days,
+                "total_days": total_days,
+                "warn_days": warn_days,
+                "alarm_days": alarm_days,
+                "source": source,
+                "ts": ts,
+            })
+    if changes:
+        con.executemany(
+            "INSERT INTO alert_levels (swab_id, level, changed_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(swab_id) DO UPDATE SET level=excluded.level, changed_at=excluded.changed_at",
+            changes,
+        )
+    if events:
+        # livello e notifica nella stessa transazione: un superamento registrato
+        # non va perso per un riavvio del worker o una destinazione ferma
+        sinks = alert_dispatcher().sinks
+        con.executemany(
+            "INSERT INTO alert_outbox (sink, payload, created_at) VALUES (?, ?, ?)",
+            [(sink.name, json.dumps(e, ensure_ascii=False, sort_keys=True), ts) for e in events for sink in sinks],
+        )
+    return events
+
+
+def alert_aging_pass() -> int:
+    """Tamponi in uso superano le soglie anche senza scansioni: controllo periodico di tutti."""
+    with connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        events = check_alert_levels(con, "aging")
+        con.commit()
+    if events:
+        alert_dispatcher().wake()
+    return len(events)
+
+
+def format_alert(event: Dict[str, Any]) -> str:
+    threshold = event["alarm_days"] if event["level"] == "alarm" else event["warn_days"]
+    label = ALERT_LEVEL_LABELS[2 if event["level"] == "alarm" else 1]
+    return (
+        f"{label} [{event['site_name']}] {event['name']} ({event['sku']}): "
+        f"{event['total_days']} gg totali, {event['current_days']} gg sessione in corso (soglia {threshold} gg)"
+    )
+
+
+class WebhookSink:
+    """POST JSON {"events": [...]} a un URL; qualsiasi risposta non 2xx è un errore."""
+
+    name = "webhook"
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, events: List[Dict[str, Any]]) -> None:
+        import urllib.request
 
-    with connect() as con:
-        barcode_settings = get_barcode_settings(con)
-        settings_hash = get_barcode_settings_hash(con)
+        req = urllib.request.Request(
+            self.url,
+            data=json.dumps({"events": events}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            if not 200 <= resp.status < 300:
+                raise RuntimeError(f"HTTP {resp.status}")
+
+
+class SmtpSink:
+    """Una e-mail per gruppo di notifiche."""
+
+    name = "smtp"
+
+    def __init__(self, host: str, port: int, sender: str, recipients: List[str],
+                 user: str = "", password: str = "", starttls: bool = False, timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, events: List[Dict[str, Any]]) -> None:
+        import smtplib
+        from email.message import EmailMessage
+
+        alarms = sum(1 for e in events if e["level"] == "alarm")
+        msg = EmailMessage()
+        msg["Subject"] = f"[Tamponi] {len(events)} soglie superate" + (f" ({alarms} allarmi)" if alarms else "")
+        msg["From"] = self.sender
+        msg["To"] = ", ".join(self.recipients)
+        msg.set_content("\n".join(format_alert(e) for e in events) + "\n")
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+            smtp.send_message(msg)
+
+
+class FileSink:
+    """Una riga JSON per notifica, in append."""
+
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, events: List[Dict[str, Any]]) -> None:
+        parent = os.path.dirname(self.path)
+        if parent:
+            ensure_dir(parent)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for e in events:
+                f.write(json.dumps(e, ensure_ascii=False, sort_keys=True) + "\n")
+
+
+class SyslogSink:
+    """NOTIFY_SYSLOG: percorso del socket (es. /dev/log) oppure host:porta UDP."""
+
+    name = "syslog"
+
+    def __init__(self, address: str):
+        import logging
+        import logging.handlers
+
+        host, sep, port = address.rpartition(":")
+        target: Any = (host, int(port)) if sep and port.isdigit() else address
+        # logger proprio per ogni sink: i logger di `logging` sono globali per nome,
+        # aggiungere un handler a uno condiviso duplicherebbe le righe a ogni istanza
+        self.logger = logging.Logger(f"tamponi.alerts.syslog.{address}", logging.INFO)
+        self.logger.addHandler(logging.handlers.SysLogHandler(address=target))
+
+    def send(self, events: List[Dict[str, Any]]) -> None:
+        import logging
+
+        for e in events:
+            self.logger.log(logging.CRITICAL if e["level"] == "alarm" else logging.WARNING, format_alert(e))
+
+
+def build_alert_sinks() -> List[Any]:
+    sinks: List[Any] = []
+    if NOTIFY_WEBHOOK_URL:
+        sinks.append(WebhookSink(NOTIFY_WEBHOOK_URL))
+    recipients = [x.strip() for x in NOTIFY_SMTP_TO.split(",") if x.strip()]
+    if NOTIFY_SMTP_HOST and recipients:
+        sinks.append(SmtpSink(
+            NOTIFY_SMTP_HOST, NOTIFY_SMTP_PORT, NOTIFY_SMTP_FROM, recipients,
+            NOTIFY_SMTP_USER, NOTIFY_SMTP_PASSWORD, NOTIFY_SMTP_STARTTLS,
+        ))
+    if NOTIFY_FILE:
+        sinks.append(FileSink(NOTIFY_FILE))
+    if NOTIFY_SYSLOG:
+        sinks.append(SyslogSink(NOTIFY_SYSLOG))
+    return sinks
+
+
+class AlertDispatcher:
+    """
+    Consegna le notifiche della tabella alert_outbox di ogni sito, con un thread
+    per destinazione: una destinazione ferma non trattiene le altre. Le righe si
+    eliminano solo dopo la consegna; in caso di errore si ritenta con attesa
+    esponenziale (fino a NOTIFY_BACKOFF_MAX_SECONDS) senza mai scartarle.
+    Più processi possono servire la stessa coda: le righe prese in carico restano
+    riservate per LEASE_SECONDS, poi tornano disponibili (es. worker terminato).
+    """
 
-    current_hash = None
-    if os.path.exists(hash_path):
-        with open(hash_path, "r", encoding="utf-8") as handle:
-            current_hash = handle.read().strip() or None
+    LEASE_SECONDS = 300.0
+
+    def __init__(self, sinks: List[Any], batch_seconds: float = NOTIFY_BATCH_SECONDS,
+                 batch_max: int = NOTIFY_BATCH_MAX, retries: int = NOTIFY_RETRIES,
+                 backoff: float = NOTIFY_BACKOFF_SECONDS, backoff_max: float = NOTIFY_BACKOFF_MAX_SECONDS,
+                 poll_seconds: float = NOTIFY_POLL_SECONDS):
+        self.sinks = sinks
+        self.batch_seconds = batch_seconds
+        self.batch_max = max(1, batch_max)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.poll_seconds = poll_seconds
+        self._wake = {sink.name: threading.Event() for sink in sinks}
+        self._threads: Dict[str, threading.Thread] = {}
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        if len(self._threads) == len(self.sinks):
+            return
+        with self._start_lock:
+            for sink in self.sinks:
+                if sink.name not in self._threads:
+                    t = threading.Thread(target=self._run, args=(sink,), name=f"alert-{sink.name}", daemon=True)
+                    self._threads[sink.name] = t
+                    t.start()
+
+    def wake(self) -> None:
+        """Dopo il commit di nuove righe in alert_outbox: consegna senza aspettare il polling."""
+        if not self._stop.is_set():
+            self.start()
+        for ev in self._wake.values():
+            ev.set()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self.wake()
+        for t in list(self._threads.values()):
+            t.join(timeout)
+
+    def pending(self) -> int:
+        """Righe ancora da consegnare nel sito corrente."""
+        names = [sink.name for sink in self.sinks]
+        if not names:
+            return 0
+        with connect() as con:
+            row = con.execute(
+                f"SELECT COUNT(*) AS n FROM alert_outbox WHERE sink IN ({','.join('?' * len(names))})",
+                names,
+            ).fetchone()
+        return int(row["n"])
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """Attende che la coda del sito corrente sia vuota."""
+        self.wake()
+        deadline = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
 
-    if os.path.exists(out_path) and current_hash == settings_hash:
-        return out_path
+    def _run(self, sink: Any) -> None:
+        ev = self._wake[sink.name]
+        timeout = self.poll_seconds
+        while not self._stop.is_set():
+            if ev.wait(timeout) and self.batch_seconds > 0:
+                # raggruppa le notifiche che arrivano a breve distanza
+                time.sleep(self.batch_seconds)
+            ev.clear()
+            if self._stop.is_set():
+                return
+            # al più tardi al prossimo tentativo programmato (backoff), altrimenti al polling
+            next_due = time.time() + self.poll_seconds
+            for site_id in SITES:
+                try:
+                    with use_site(site_id):
+                        due = self._drain(sink)
+                    if due is not None:
+                        next_due = min(next_due, due)
+                except Exception as exc:  # il thread non deve morire per un sito irraggiungibile
+                    app.logger.error("Notifiche %s (%s): %s", sink.name, site_id, exc)
+            timeout = max(0.0, next_due - time.time())
+
+    def _claim(self, sink: Any) -> List[sqlite3.Row]:
+        now = time.time()
+        with connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            rows = con.execute(
+                "SELECT id, payload, attempts FROM alert_outbox "
+                "WHERE sink = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (sink.name, now, self.batch_max),
+            ).fetchall()
+            con.executemany(
+                "UPDATE alert_outbox SET next_attempt = ? WHERE id = ?",
+                [(now + self.LEASE_SECONDS, r["id"]) for r in rows],
+            )
+            con.commit()
+        return rows
+
+    def _drain(self, sink: Any) -> Optional[float]:
+        """Consegna le righe scadute del sito corrente; restituisce quando scade la prossima."""
+        while True:
+            rows = self._claim(sink)
+            if not rows:
+                break
+            try:
+                sink.send([json.loads(r["payload"]) for r in rows])
+            except Exception as exc:
+                self._failed(sink, rows, exc)
+                break
+            with connect() as con:
+                con.executemany("DELETE FROM alert_outbox WHERE id = ?", [(r["id"],) for r in rows])
+                con.commit()
+        with connect() as con:
+            row = con.execute("SELECT MIN(next_attempt) AS due FROM alert_outbox WHERE sink = ?", (sink.name,)).fetchone()
+        return row["due"]
 
-    if os.path.exists(out_path):
-        os.remove(out_path)
+    def _failed(self, sink: Any, rows: List[sqlite3.Row], exc: Exception) -> None:
+        attempts = max(int(r["attempts"]) for r in rows) + 1
+        wait = min(self.backoff * (2 ** (attempts - 1)), self.backoff_max)
+        with connect() as con:
+            con.executemany(
+                "UPDATE alert_outbox SET attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE id = ?",
+                [(time.time() + wait, str(exc)[:500], r["id"]) for r in rows],
+            )
+            con.commit()
+        if attempts == self.retries:
+            app.logger.error(
+                "Notifiche %s: %d non consegnate dopo %d tentativi (%s), continuo a riprovare ogni %.0fs al massimo",
+                sink.name, len(rows), attempts, exc, self.backoff_max,
+            )
+        else:
+            app.logger.warning("Notifiche %s: tentativo %d fallito (%s), riprovo tra %.1fs", sink.name, attempts, exc, wait)
 
-    writer = ImageWriter()
-    code = Code128(sku, writer=writer)
-    code.save(
-        os.path.join(LABELS_DIR, sku),
-        options=barcode_settings,
-    )
-    with open(hash_path, "w", encoding="utf-8") as handle:
-        handle.write(settings_hash)
-    return out_path
 
+_alert_dispatcher: Optional[AlertDispatcher] = None
+_alert_dispatcher_lock = threading.Lock()
 
-def open_taken_ts(con: sqlite3.Connection, swab_id: int) -> Optional[str]:
-    row = con.execute(
-        "SELECT taken_ts FROM usage_sessions WHERE swab_id=? AND returned_ts IS NULL ORDER BY taken_ts DESC LIMIT 1",
-        (swab_id,),
-    ).fetchone()
-    return row["taken_ts"] if row else None
 
+def alert_dispatcher() -> AlertDispatcher:
+    global _alert_dispatcher
+    if _alert_dispatcher is None:
+        with _alert_dispatcher_lock:
+            if _alert_dispatcher is None:
+                _alert_dispatcher = AlertDispatcher(build_alert_sinks())
+    return _alert_dispatcher
 
-def total_unique_days(con: sqlite3.Connection, swab_id: int) -> int:
-    row = con.execute("SELECT COUNT(*) AS c FROM usage_days WHERE swab_id=?", (swab_id,)).fetchone()
-    return int(row["c"]) if row else 0
 
+def alerts_enabled() -> bool:
+    return bool(alert_dispatcher().sinks)
 
-def add_usage_days_for_range(con: sqlite3.Connection, swab_id: int, start_iso: str, end_iso: str) -> int:
-    a_dt = parse_iso(start_iso)
-    b_dt = parse_iso(end_iso)
-    if a_dt.date() == b_dt.date() and (b_dt - a_dt) <= timedelta(hours=2):
-        return 0
-    a = a_dt.date()
-    b = b_dt.date()
-    before = con.total_changes
-    for d in iter_dates_inclusive(a, b):
-        con.execute(
-            "INSERT OR IGNORE INTO usage_days (swab_id, day) VALUES (?, ?)",
-            (swab_id, date_to_key(d)),
-        )
-    after = con.total_changes
-    return max(0, after - before)
 
+@app.cli.command("notify-test")
+def notify_test_command() -> None:
+    """Invia una notifica di prova a ogni destinazione configurata (NOTIFY_*)."""
+    sinks = build_alert_sinks()
+    if not sinks:
+        raise SystemExit("Nessuna destinazione configurata (NOTIFY_WEBHOOK_URL, NOTIFY_SMTP_*, NOTIFY_FILE, NOTIFY_SYSLOG).")
+    site = current_site()
+    event = {
+        "site": site["id"], "site_name": site["name"], "swab_id": 0, "sku": "TEST", "name": "Notifica di prova",
+        "level": "warn", "current_days": 0, "total_days": 0,
+        "warn_days": DEFAULT_GLOBAL_WARN_DAYS, "alarm_days": DEFAULT_GLOBAL_ALARM_DAYS,
+        "source": "test", "ts": now_iso(),
+    }
+    for sink in sinks:
+        try:
+            sink.send([event])
+            print(f"{sink.name}: ok")
+        except Exception as exc:
+            print(f"{sink.name}: ERRORE {exc}")
 
-def list_machines(con: sqlite3.Connection) -> List[Dict[str, Any]]:
-    rows = con.execute("SELECT id, name FROM machines ORDER BY name COLLATE NOCASE").fetchall()
-    return [{"id": int(r["id"]), "name": r["name"]} for r in rows]
 
+# ---------------------------
+# Riepilogo multi-sito
+# ---------------------------
+def site_summary() -> Dict[str, Any]:
+    site = current_site()
+    ensure_db()
+    with read_connection() as con:
+        row = con.execute(
+            """
+            SELECT COUNT(*) AS swabs,
+                   COALESCE(SUM(CASE WHEN COALESCE(st.in_stock, 1) = 0 THEN 1 ELSE 0 END), 0) AS taken
+            FROM swabs s
+            LEFT JOIN swab_state st ON st.swab_id = s.id
+            """
+        ).fetchone()
+        machines = con.execute("SELECT COUNT(*) AS c FROM machines").fetchone()["c"]
+        last = con.execute("SELECT ts FROM movements ORDER BY ts_epoch DESC LIMIT 1").fetchone()
+        forecast = get_forecast(con)
+    return {
+        "id": site["id"],
+        "name": site["name"],
+        "swabs": int(row["swabs"]),
+        "taken": int(row["taken"]),
+        "machines": int(machines),
+        "last_movement_ts": last["ts"] if last else None,
+        "warning": sum(1 for f in forecast if f["days_to_warn"] == 0),
+        "alarm": sum(1 for f in forecast if f["days_to_alarm"] == 0),
+        "error": None,
+    }
 
-def machine_exists(con: sqlite3.Connection, machine_id: int) -> bool:
-    r = con.execute("SELECT 1 FROM machines WHERE id=?", (machine_id,)).fetchone()
-    return bool(r)
+
+def collect_site_summaries() -> List[Dict[str, Any]]:
+    """Interroga tutti i database in parallelo: un thread per sito."""
+
+    def _one(site_id: str) -> Dict[str, Any]:
+        with use_site(site_id):
+            try:
+                return site_summary()
+            except (sqlite3.Error, OSError) as exc:
+                return {"id": site_id, "name": SITES[site_id]["name"], "error": str(exc)}
+
+    with ThreadPoolExecutor(max_workers=min(8, len(SITES))) as pool:
+        return list(pool.map(_one, SITES))
 
 
 # ---------------------------
@@ -488,10 +2640,23 @@ def home():
     return redirect(url_for("swabs"))
 
 
+@app.errorhandler(sqlite3.OperationalError)
+def handle_db_busy(exc: sqlite3.OperationalError):
+    # "database is locked" dopo busy_timeout: risposta esplicita, lo scanner può ritentare
+    if "locked" in str(exc) or "busy" in str(exc):
+        app.logger.warning("Database occupato su %s: %s", request.path, exc)
+        return jsonify({"ok": False, "error": "Database occupato, riprova.", "locked": True}), 503
+    raise exc
+
+
 # --- Public pages ---
-def fetch_swabs(query: str) -> List[Dict[str, Any]]:
+def iter_swabs(query: str) -> Iterator[Dict[str, Any]]:
+    """
+    Righe della lista tamponi lette dal cursore una alla volta (niente fetchall):
+    la pagina viene inviata mentre si legge, la memoria non cresce con le righe.
+    """
     like_query = f"%{query}%"
-    with connect() as con:
+    with read_connection() as con:
         warn_days = get_global_warn_days(con)
         alarm_days = get_global_alarm_days(con)
         sql = """
@@ -502,7 +2667,10 @@ def fetch_swabs(query: str) -> List[Dict[str, Any]]:
                    mc.name AS machine_name,
 
                    (SELECT mv.ts FROM movements mv WHERE mv.swab_id=s.id AND mv.action='TAKE' ORDER BY mv.ts DESC LIMIT 1) AS last_take_ts,
-                   (SELECT mv.ts FROM movements mv WHERE mv.swab_id=s.id AND mv.action='RETURN' ORDER BY mv.ts DESC LIMIT 1) AS last_return_ts
+                   (SELECT mv.ts FROM movements mv WHERE mv.swab_id=s.id AND mv.action='RETURN' ORDER BY mv.ts DESC LIMIT 1) AS last_return_ts,
+                   (SELECT us.taken_ts FROM usage_sessions us WHERE us.swab_id=s.id AND us.returned_ts IS NULL ORDER BY us.taken_epoch DESC LIMIT 1) AS open_taken_ts,
+                   (SELECT us.taken_epoch FROM usage_sessions us WHERE us.swab_id=s.id AND us.returned_ts IS NULL ORDER BY us.taken_epoch DESC LIMIT 1) AS open_taken_epoch,
+                   (SELECT COUNT(*) FROM usage_days ud WHERE ud.swab_id=s.id) AS total_days
             FROM swabs s
             LEFT JOIN swab_state st ON st.swab_id = s.id
             LEFT JOIN machines mc ON mc.id = st.machine_id
@@ -516,19 +2684,16 @@ def fetch_swabs(query: str) -> List[Dict[str, Any]]:
             params = (like_query, like_query)
         sql += "ORDER BY s.name COLLATE NOCASE"
 
-        rows = con.execute(sql, params).fetchall()
-
-        enriched: List[Dict[str, Any]] = []
-        for r in rows:
-            swab_id = int(r["id"])
-            ot = open_taken_ts(con, swab_id)
-            current_days = current_calendar_days(ot) if ot else 0
-            total_days = total_unique_days(con, swab_id)
+        now = now_epoch()
+        for r in con.execute(sql, params):
+            ot = r["open_taken_ts"]
+            current_days = current_calendar_days(r["open_taken_epoch"], now) if ot else 0
+            total_days = int(r["total_days"])
             is_warning = current_days > warn_days or total_days > warn_days
             is_alarm = current_days > alarm_days or total_days > alarm_days
 
-            enriched.append({
-                "id": swab_id,
+            yield {
+                "id": int(r["id"]),
                 "sku": r["sku"],
                 "name": r["name"],
                 "in_stock": int(r["in_stock"]),
@@ -541,24 +2706,45 @@ def fetch_swabs(query: str) -> List[Dict[str, Any]]:
                 "last_take_ts": r["last_take_ts"],
                 "last_return_ts": r["last_return_ts"],
                 "machine_name": r["machine_name"],
-            })
-    return enriched
+            }
+
+
+def buffered_chunks(chunks: Iterable[str], size: int = 16 * 1024) -> Iterator[str]:
+    # raggruppa i frammenti di Jinja: meno write sul socket, primo byte comunque subito
+    buf: List[str] = []
+    n = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        n += len(chunk)
+        if n >= size:
+            yield "".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield "".join(buf)
+
+
+def stream_page(template_name: str, **context: Any) -> Response:
+    """
+    Come render_template ma in streaming. I messaggi flash vengono letti prima,
+    così la sessione aggiornata parte con gli header e non si ripresentano.
+    """
+    get_flashed_messages(with_categories=True)
+    return Response(buffered_chunks(stream_template(template_name, **context)), mimetype="text/html")
 
 
 @app.route("/swabs", methods=["GET"])
 def swabs():
-    init_db()
+    ensure_db()
 
     # GET pubblico
     query = (request.args.get("q") or "").strip()
-    enriched = fetch_swabs(query)
-    with connect() as con:
+    with read_connection() as con:
         warn_days = get_global_warn_days(con)
         alarm_days = get_global_alarm_days(con)
 
-    return render_template(
+    return stream_page(
         "swabs.html",
-        rows=enriched,
+        rows=iter_swabs(query),
         global_warn_days=warn_days,
         global_alarm_days=alarm_days,
         q=query,
@@ -574,7 +2760,7 @@ def admin_dashboard():
 @app.route("/admin/settings", methods=["GET", "POST"])
 @require_admin
 def admin_settings():
-    init_db()
+    ensure_db()
     with connect() as con:
         if request.method == "POST":
             action = (request.form.get("action") or "update_settings").strip()
@@ -655,8 +2841,11 @@ def admin_settings():
                 "text_distance": text_distance,
                 "write_text": raw_write_text == "1",
             })
+            barcode_changed = barcode_hash != get_barcode_settings_hash(con)
             set_setting(con, SETTINGS_KEY_BARCODE_SETTINGS_HASH, barcode_hash)
             con.commit()
+            if barcode_changed:
+                start_label_rerender()
             flash("Impostazioni aggiornate.", "ok")
             return redirect(url_for("admin_settings"))
 
@@ -671,10 +2860,73 @@ def admin_settings():
     )
 
 
+@app.route("/admin/forecast")
+@require_admin
+def admin_forecast():
+    ensure_db()
+    try:
+        horizon = int(request.args.get("days", FORECAST_HORIZON_DAYS))
+    except ValueError:
+        horizon = FORECAST_HORIZON_DAYS
+    horizon = max(1, min(horizon, 3650))
+    with read_connection() as con:
+        rows = due_soon(get_forecast(con), horizon)
+        warn_days = get_global_warn_days(con)
+        alarm_days = get_global_alarm_days(con)
+    return render_template(
+        "admin_forecast.html",
+        rows=rows,
+        horizon=horizon,
+        window=FORECAST_WINDOW_DAYS,
+        global_warn_days=warn_days,
+        global_alarm_days=alarm_days,
+    )
+
+
+@app.route("/admin/sites")
+@require_admin
+def admin_sites():
+    summaries = collect_site_summaries()
+    # link alla stessa pagina lista tamponi di ogni sito
+    swabs_path = url_for("swabs")[len(request.script_root):]
+    for sm in summaries:
+        prefix = "" if sm["id"] == DEFAULT_SITE_ID else f"/site/{sm['id']}"
+        sm["url"] = prefix + swabs_path
+    return render_template("admin_sites.html", sites=summaries)
+
+
+@app.route("/admin/backups", methods=["GET", "POST"])
+@require_admin
+def admin_backups():
+    ensure_db()
+    if request.method == "POST":
+        try:
+            path = backup_db()
+            flash(f"Backup creato: {os.path.basename(path)}", "ok")
+        except (sqlite3.Error, OSError) as exc:
+            flash(f"Backup non riuscito: {exc}", "error")
+        return redirect(url_for("admin_backups"))
+
+    return render_template(
+        "admin_backups.html",
+        backups=list_backups(),
+        keep=BACKUP_KEEP,
+        interval_hours=BACKUP_INTERVAL_HOURS,
+    )
+
+
+@app.route("/admin/backups/<name>")
+@require_admin
+def admin_backup_download(name: str):
+    if name not in {b["name"] for b in list_backups()}:
+        return "Backup non trovato", 404
+    return send_file(os.path.join(site_backup_dir(), name), as_attachment=True, download_name=name)
+
+
 @app.route("/admin/swabs", methods=["GET", "POST"])
 @require_admin
 def admin_swabs():
-    init_db()
+    ensure_db()
 
     if request.method == "POST":
         action = request.form.get("action", "")
@@ -707,49 +2959,62 @@ def admin_swabs():
         return redirect(url_for("admin_swabs"))
 
     query = (request.args.get("q") or "").strip()
-    enriched = fetch_swabs(query)
-    with connect() as con:
+    with read_connection() as con:
         warn_days = get_global_warn_days(con)
         alarm_days = get_global_alarm_days(con)
-    return render_template(
+    return stream_page(
         "admin_swabs.html",
-        rows=enriched,
+        rows=iter_swabs(query),
         global_warn_days=warn_days,
         global_alarm_days=alarm_days,
         q=query,
+        label_printers=sorted(LABEL_PRINTERS),
     )
 
 
 @app.route("/history")
 def history():
-    init_db()
+    ensure_db()
     limit = int(request.args.get("limit", "150"))
-    limit = max(1, min(limit, 500))
+    # con lo streaming anche pagine lunghe costano memoria costante
+    limit = max(1, min(limit, 5000))
+
+    def _rows() -> Iterator[sqlite3.Row]:
+        with read_connection() as con:
+            yield from con.execute(
+                """
+                SELECT mv.ts, mv.action,
+                       sw.id AS swab_id, sw.sku, sw.name,
+                       COALESCE(mv.note,'') AS note,
+                       mc.name AS machine_name
+                FROM movements mv
+                JOIN swabs sw ON sw.id = mv.swab_id
+                LEFT JOIN machines mc ON mc.id = mv.machine_id
+                ORDER BY mv.ts_epoch DESC, mv.id DESC
+                LIMIT ?
+                """,
+                (limit,),
+            )
 
-    with connect() as con:
-        rows = con.execute(
-            """
-            SELECT mv.ts, mv.action,
-                   sw.sku, sw.name,
-                   COALESCE(mv.note,'') AS note,
-                   mc.name AS machine_name
-            FROM movements mv
-            JOIN swabs sw ON sw.id = mv.swab_id
-            LEFT JOIN machines mc ON mc.id = mv.machine_id
-            ORDER BY mv.ts DESC
-            LIMIT ?
-            """,
-            (limit,),
-        ).fetchall()
+    return stream_page("history.html", rows=_rows(), limit=limit)
 
-    return render_template("history.html", rows=rows, limit=limit)
+
+@app.route("/swabs/<int:swab_id>")
+def swab_detail(swab_id: int):
+    ensure_db()
+    with read_connection() as con:
+        timeline = swab_timeline(con, swab_id)
+    if timeline is None:
+        flash("Tampone non trovato.", "error")
+        return redirect(url_for("swabs"))
+    return render_template("swab_detail.html", t=timeline)
 
 
 # --- Protected swab edit/delete ---
 @app.route("/swabs/<int:swab_id>/edit", methods=["GET", "POST"])
 @require_admin
 def swab_edit(swab_id: int):
-    init_db()
+    ensure_db()
     with connect() as con:
         sw = get_swab_by_id(con, swab_id)
         if not sw:
@@ -766,6 +3031,8 @@ def swab_edit(swab_id: int):
 
             try:
                 con.execute("UPDATE swabs SET name=?, sku=? WHERE id=?", (new_name, new_sku, swab_id))
+                # nome/SKU compaiono nella previsione in cache: invalidala in tutti i worker
+                bump_generation(con, SETTINGS_KEY_CATALOG_GENERATION)
                 con.commit()
                 ensure_label_png(new_sku)
                 flash("Tampone aggiornato.", "ok")
@@ -779,7 +3046,7 @@ def swab_edit(swab_id: int):
 @app.route("/swabs/<int:swab_id>/delete", methods=["POST"])
 @require_admin
 def swab_delete(swab_id: int):
-    init_db()
+    ensure_db()
     with connect() as con:
         sw = get_swab_by_id(con, swab_id)
         if not sw:
@@ -808,7 +3075,7 @@ def machines_redirect():
 @app.route("/admin/machines", methods=["GET", "POST"])
 @require_admin
 def admin_machines():
-    init_db()
+    ensure_db()
 
     if request.method == "POST":
         action = request.form.get("action", "")
@@ -854,40 +3121,159 @@ def admin_machines():
     return render_template("admin_machines.html", machines=ms)
 
 
+@app.route("/admin/import", methods=["GET", "POST"])
+@require_admin
+def admin_import():
+    ensure_db()
+    result = None
+    kind = (request.form.get("kind") or "swabs").strip()
+
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if kind not in ("swabs", "machines"):
+            flash("Tipo di import non valido.", "error")
+            return redirect(url_for("admin_import"))
+        if not upload or not upload.filename:
+            flash("Seleziona un file CSV o XLSX.", "error")
+            return redirect(url_for("admin_import"))
+
+        try:
+            rows = read_import_rows(upload.filename, upload.read())
+        except (ValueError, csv.Error) as exc:
+            flash(f"File non leggibile: {exc}", "error")
+            return redirect(url_for("admin_import"))
+
+        with connect() as con:
+            try:
+                if kind == "swabs":
+                    result = import_swabs(con, rows)
+                else:
+                    result = import_machines(con, rows)
+                con.commit()
+            except sqlite3.IntegrityError as exc:
+                con.rollback()
+                result = {"inserted": 0, "errors": [f"Import annullato: {exc}"], "duplicates": []}
+
+        if result["inserted"]:
+            if kind == "swabs":
+                start_label_rerender()
+            flash(f"Import completato: {result['inserted']} righe inserite.", "ok")
+        elif not result["errors"] and not result["duplicates"]:
+            flash("Il file non contiene righe da importare.", "error")
+        else:
+            flash("Import annullato: correggi gli errori e riprova.", "error")
+
+    return render_template("admin_import.html", result=result, kind=kind)
+
+
 # --- Scanning pages (public) ---
+# Pagine di scansione statiche (nessuna query): soglie e macchine arrivano da
+# /api/scan-config, pagine e config le tiene in cache il service worker
 @app.route("/scan")
 def scan():
-    init_db()
-    with connect() as con:
-        warn_days = get_global_warn_days(con)
-        alarm_days = get_global_alarm_days(con)
-    return render_template(
-        "scan.html",
-        global_warn_days=warn_days,
-        global_alarm_days=alarm_days,
-    )
+    return render_template("scan.html")
 
 
 @app.route("/scan-camera")
 def scan_camera():
-    init_db()
-    with connect() as con:
-        warn_days = get_global_warn_days(con)
-        alarm_days = get_global_alarm_days(con)
-    return render_template(
-        "scan_camera.html",
-        global_warn_days=warn_days,
-        global_alarm_days=alarm_days,
-    )
+    scanner_js = scanner_asset_url()
+    if not scanner_js:
+        # niente ripiego su CDN: la pagina dice cosa manca (503, non finisce in cache)
+        app.logger.error("%s mancante in static/: installazione incompleta", BUILTIN_SCANNER_ASSET)
+        return render_template("scan_camera.html", scanner_js=None), 503
+    return render_template("scan_camera.html", scanner_js=scanner_js)
+
+
+@app.route("/api/scan-config")
+def api_scan_config():
+    ensure_db()
+    with read_connection() as con:
+        return jsonify({
+            "ok": True,
+            "machines": list_machines(con),
+            "warn_days": get_global_warn_days(con),
+            "alarm_days": get_global_alarm_days(con),
+        })
 
 
 @app.route("/api/machines")
 def api_machines():
-    init_db()
-    with connect() as con:
+    ensure_db()
+    with read_connection() as con:
         return jsonify({"ok": True, "machines": list_machines(con)})
 
 
+@app.route("/api/inventory")
+def api_inventory():
+    """
+    Inventario a una data: /api/inventory?at=2026-03-01T12:00:00[&machine_id=N]
+    Senza `at` restituisce lo stato attuale.
+    """
+    ensure_db()
+    raw_at = (request.args.get("at") or "").strip()
+    try:
+        at_iso = parse_at_param(raw_at) if raw_at else now_iso()
+    except ValueError:
+        return jsonify({"ok": False, "error": "Parametro at non valido (ISO 8601)"}), 400
+    raw_mid = (request.args.get("machine_id") or "").strip()
+    try:
+        machine_id = int(raw_mid) if raw_mid else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "machine_id non valido"}), 400
+
+    with read_connection() as con:
+        result = inventory_at(con, at_iso)
+    if machine_id is not None:
+        result["swabs"] = [sw for sw in result["swabs"] if sw["machine_id"] == machine_id]
+    return jsonify({"ok": True, **result})
+
+
+@app.route("/api/swabs/<int:swab_id>/timeline")
+def api_swab_timeline(swab_id: int):
+    ensure_db()
+    with read_connection() as con:
+        timeline = swab_timeline(con, swab_id)
+    if timeline is None:
+        return jsonify({"ok": False, "error": "Tampone non trovato"}), 404
+    return jsonify({"ok": True, **timeline})
+
+
+# Tutto ciò che serve a una scansione in una sola istruzione: tampone, stato,
+# sessione aperta, giorni registrati, macchina richiesta, soglie e livello già
+# notificato. Testo SQL costante: sqlite3 riusa lo statement preparato dalla cache.
+SCAN_CONTEXT_SQL = """
+    SELECT s.id, s.name,
+           COALESCE(st.in_stock, 1) AS in_stock,
+           us.id AS open_session_id,
+           us.taken_epoch AS open_taken_epoch,
+           (SELECT COUNT(*) FROM usage_days ud WHERE ud.swab_id = s.id) AS total_days,
+           (SELECT mc.name FROM machines mc WHERE mc.id = :machine_id) AS machine_name,
+           (SELECT value FROM settings WHERE key = :warn_key) AS warn_days,
+           (SELECT value FROM settings WHERE key = :alarm_key) AS alarm_days,
+           COALESCE(al.level, 0) AS notified_level
+    FROM swabs s
+    LEFT JOIN swab_state st ON st.swab_id = s.id
+    LEFT JOIN usage_sessions us ON us.id = (
+        SELECT id FROM usage_sessions
+        WHERE swab_id = s.id AND returned_ts IS NULL
+        ORDER BY taken_epoch DESC LIMIT 1
+    )
+    LEFT JOIN alert_levels al ON al.swab_id = s.id
+    WHERE s.sku = :sku
+"""
+
+# Giorni della sessione (epoch-day da..a) come righe usage_days; OR IGNORE +
+# RETURNING restituisce solo i giorni non già registrati
+SCAN_USAGE_DAYS_SQL = """
+    WITH RECURSIVE d(n) AS (
+        SELECT ? UNION ALL SELECT n + 1 FROM d WHERE n < ?
+    )
+    INSERT OR IGNORE INTO usage_days (swab_id, day)
+    SELECT ?, date(n * 86400, 'unixepoch') FROM d
+    RETURNING day_num
+"""
+
+
 @app.route("/api/scan", methods=["POST"])
 def api_scan():
     """
@@ -896,7 +3282,7 @@ def api_scan():
     - Se l'azione risultante è TAKE e machine_id non c'è -> 409 need_machine con lista macchine
     - Su RETURN ignora machine_id e svuota la macchina (magazzino)
     """
-    init_db()
+    ensure_db()
     data: Dict[str, Any] = request.get_json(force=True) or {}
     sku = (data.get("sku") or "").strip()
     mode = (data.get("mode") or "TOGGLE").upper()
@@ -907,30 +3293,42 @@ def api_scan():
     if mode not in ("TOGGLE", "TAKE", "RETURN"):
         return jsonify({"ok": False, "error": "mode non valido"}), 400
 
+    try:
+        mid_int = int(machine_id) if machine_id is not None else None
+    except (TypeError, ValueError):
+        mid_int = None
+
     with connect() as con:
-        sw = get_swab_by_sku(con, sku)
-        if not sw:
+        # lock di scrittura prima di leggere il contesto: due postazioni (anche su
+        # worker diversi) non possono vedere entrambe "nessuna sessione aperta"
+        con.execute("BEGIN IMMEDIATE")
+        ctx = con.execute(
+            SCAN_CONTEXT_SQL,
+            {
+                "sku": sku,
+                "machine_id": mid_int,
+                "warn_key": SETTINGS_KEY_WARN_DAYS,
+                "alarm_key": SETTINGS_KEY_ALARM_DAYS,
+            },
+        ).fetchone()
+        if not ctx:
+            con.rollback()
             return jsonify({"ok": False, "error": f"SKU non trovato: {sku}"}), 404
 
-        swab_id = int(sw["id"])
-        state = get_state(con, swab_id)
-        current_in_stock = int(state["in_stock"])  # 1=RESO, 0=PRESO
+        swab_id = int(ctx["id"])
+        current_in_stock = int(ctx["in_stock"])  # 1=RESO, 0=PRESO
 
         if mode == "TAKE":
-            action, new_in_stock = "TAKE", 0
+            action = "TAKE"
         elif mode == "RETURN":
-            action, new_in_stock = "RETURN", 1
+            action = "RETURN"
         else:
-            action, new_in_stock = ("TAKE", 0) if current_in_stock == 1 else ("RETURN", 1)
+            action = "TAKE" if current_in_stock == 1 else "RETURN"
 
         # TAKE: richiede macchina
         if action == "TAKE":
-            try:
-                mid_int = int(machine_id) if machine_id is not None else None
-            except Exception:
-                mid_int = None
-
             if not mid_int:
+                con.rollback()
                 return jsonify({
                     "ok": False,
                     "need_machine": True,
@@ -940,76 +3338,77 @@ def api_scan():
                     "mode": mode
                 }), 409
 
-            if not machine_exists(con, mid_int):
+            if ctx["machine_name"] is None:
+                con.rollback()
                 return jsonify({"ok": False, "error": "Macchina non valida"}), 400
 
         ts = now_iso()
+        now = iso_to_epoch(ts)
         days_session = None
         added_unique_days = 0
+        open_taken = ctx["open_taken_epoch"]
 
         if action == "TAKE":
             con.execute(
                 "INSERT INTO movements (swab_id, action, machine_id, ts, note) VALUES (?, 'TAKE', ?, ?, NULL)",
-                (swab_id, int(machine_id), ts),
+                (swab_id, mid_int, ts),
             )
-
             # apre sessione se non esiste già aperta
-            open_sess = con.execute(
-                "SELECT id FROM usage_sessions WHERE swab_id=? AND returned_ts IS NULL ORDER BY taken_ts DESC LIMIT 1",
-                (swab_id,),
-            ).fetchone()
-            if not open_sess:
-                con.execute(
-                    "INSERT INTO usage_sessions (swab_id, taken_ts, returned_ts) VALUES (?, ?, NULL)",
+            if ctx["open_session_id"] is None:
+                open_taken = con.execute(
+                    "INSERT INTO usage_sessions (swab_id, taken_ts, returned_ts) VALUES (?, ?, NULL) "
+                    "RETURNING taken_epoch",
                     (swab_id, ts),
-                )
-
-            # stato: preso + macchina
-            set_state(con, swab_id, 0, int(machine_id))
-
+                ).fetchone()["taken_epoch"]
+            machine_for_state: Optional[int] = mid_int
         else:
             con.execute(
                 "INSERT INTO movements (swab_id, action, machine_id, ts, note) VALUES (?, 'RETURN', NULL, ?, NULL)",
                 (swab_id, ts),
             )
-
-            sess = con.execute(
-                "SELECT id, taken_ts FROM usage_sessions WHERE swab_id=? AND returned_ts IS NULL ORDER BY taken_ts DESC LIMIT 1",
-                (swab_id,),
-            ).fetchone()
-            if sess:
-                taken_ts = sess["taken_ts"]
-                days_session = calendar_days_between(taken_ts, ts)
-                con.execute("UPDATE usage_sessions SET returned_ts=? WHERE id=?", (ts, sess["id"]))
-                added_unique_days = add_usage_days_for_range(con, swab_id, taken_ts, ts)
-
-            # stato: reso => macchina NULL
-            set_state(con, swab_id, 1, None)
-
-        ot = open_taken_ts(con, swab_id)
-        current_days = current_calendar_days(ot) if ot else 0
-        total_days = total_unique_days(con, swab_id)
-        warn_days = get_global_warn_days(con)
-        alarm_days = get_global_alarm_days(con)
-        is_warning = current_days > warn_days or total_days > warn_days
-        is_alarm = current_days > alarm_days or total_days > alarm_days
-
-        # macchina corrente (solo se preso)
-        st2 = get_state(con, swab_id)
-        machine_name = None
-        if st2["machine_id"]:
-            m = con.execute("SELECT name FROM machines WHERE id=?", (int(st2["machine_id"]),)).fetchone()
-            machine_name = m["name"] if m else None
-
+            if ctx["open_session_id"] is not None:
+                days_session = calendar_days_between_epoch(open_taken, now)
+                con.execute("UPDATE usage_sessions SET returned_ts=? WHERE id=?", (ts, ctx["open_session_id"]))
+                if days_session > 0:
+                    # un solo INSERT per tutti i giorni della sessione; RETURNING conta solo i nuovi
+                    added_unique_days = len(con.execute(
+                        SCAN_USAGE_DAYS_SQL,
+                        (open_taken // DAY_SECONDS, now // DAY_SECONDS, swab_id),
+                    ).fetchall())
+            open_taken = None
+            machine_for_state = None
+
+        st2 = con.execute(
+            "INSERT OR REPLACE INTO swab_state (swab_id, in_stock, machine_id, updated_at) VALUES (?, ?, ?, ?) "
+            "RETURNING in_stock, machine_id",
+            (swab_id, 0 if action == "TAKE" else 1, machine_for_state, ts),
+        ).fetchone()
+
+        current_days = calendar_days_between_epoch(open_taken, now) if open_taken is not None else 0
+        total_days = int(ctx["total_days"]) + added_unique_days
+        warn_days = parse_positive_int(ctx["warn_days"], DEFAULT_GLOBAL_WARN_DAYS)
+        alarm_days = parse_positive_int(ctx["alarm_days"], DEFAULT_GLOBAL_ALARM_DAYS)
+        level = alert_level(current_days, total_days, warn_days, alarm_days)
+
+        alerts: List[Dict[str, Any]] = []
+        if alerts_enabled():
+            alerts = record_alert_levels(
+                con, "scan",
+                [(swab_id, sku, ctx["name"], int(ctx["notified_level"]), current_days, total_days)],
+                warn_days, alarm_days, ts,
+            )
         con.commit()
+        # consegna nei thread delle notifiche: la risposta allo scanner non aspetta
+        if alerts:
+            alert_dispatcher().wake()
 
         return jsonify({
             "ok": True,
             "sku": sku,
-            "name": sw["name"],
+            "name": ctx["name"],
             "action": action,
-            "in_stock": bool(new_in_stock == 1),
-            "machine_name": machine_name,
+            "in_stock": bool(st2["in_stock"] == 1),
+            "machine_name": ctx["machine_name"] if st2["machine_id"] is not None else None,
             "ts": ts,
             "days_session": days_session,
             "added_unique_days": added_unique_days,
@@ -1017,19 +3416,137 @@ def api_scan():
             "total_days": total_days,
             "warn_days": warn_days,
             "alarm_days": alarm_days,
-            "warning": is_warning,
-            "alarm": is_alarm,
+            "warning": level >= 1,
+            "alarm": level >= 2,
         })
 
 
+# --- Admin API: operazioni massive ---
+@app.route("/api/admin/machines/<int:machine_id>/return-all", methods=["POST"])
+@require_admin
+def api_return_all_on_machine(machine_id: int):
+    ensure_db()
+    with connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        if not machine_exists(con, machine_id):
+            con.rollback()
+            return jsonify({"ok": False, "error": "Macchina non valida"}), 404
+        create_bulk_targets(con)
+        con.execute(
+            "INSERT INTO temp.bulk_targets (swab_id) "
+            "SELECT swab_id FROM swab_state WHERE machine_id=? AND in_stock=0",
+            (machine_id,),
+        )
+        skus = bulk_target_skus(con)
+        ts = now_iso()
+        n = bulk_return(con, ts)
+        alerts = check_alert_levels(con, "bulk", "WHERE s.id IN (SELECT swab_id FROM temp.bulk_targets)")
+        drop_bulk_targets(con)
+        con.commit()
+    if alerts:
+        alert_dispatcher().wake()
+    return jsonify({"ok": True, "action": "RETURN", "count": n, "skus": skus, "ts": ts})
+
+
+@app.route("/api/admin/machines/<int:machine_id>/move-all", methods=["POST"])
+@require_admin
+def api_move_all_from_machine(machine_id: int):
+    ensure_db()
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    try:
+        to_machine_id = int(data.get("to_machine_id"))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "to_machine_id mancante"}), 400
+    if to_machine_id == machine_id:
+        return jsonify({"ok": False, "error": "Macchina di destinazione uguale all'origine"}), 400
+
+    with connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        if not machine_exists(con, machine_id) or not machine_exists(con, to_machine_id):
+            con.rollback()
+            return jsonify({"ok": False, "error": "Macchina non valida"}), 404
+        from_name = con.execute("SELECT name FROM machines WHERE id=?", (machine_id,)).fetchone()["name"]
+        create_bulk_targets(con)
+        con.execute(
+            "INSERT INTO temp.bulk_targets (swab_id) "
+            "SELECT swab_id FROM swab_state WHERE machine_id=? AND in_stock=0",
+            (machine_id,),
+        )
+        skus = bulk_target_skus(con)
+        ts = now_iso()
+        n = bulk_move(con, to_machine_id, ts, note=f"Spostato da {from_name}")
+        drop_bulk_targets(con)
+        con.commit()
+    return jsonify({"ok": True, "action": "MOVE", "count": n, "skus": skus, "ts": ts})
+
+
+@app.route("/api/admin/return", methods=["POST"])
+@require_admin
+def api_return_skus():
+    """
+    JSON: { skus: ["...", ...] }
+    Rende i tamponi indicati; SKU sconosciuti o già RESI vengono solo segnalati.
+    """
+    ensure_db()
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    raw = data.get("skus") or []
+    if not isinstance(raw, list):
+        return jsonify({"ok": False, "error": "skus deve essere una lista"}), 400
+    skus = list(dict.fromkeys(str(x).strip() for x in raw if str(x).strip()))
+    if not skus:
+        return jsonify({"ok": False, "error": "Nessuno SKU"}), 400
+
+    with connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_skus (sku TEXT PRIMARY KEY)")
+        con.execute("DELETE FROM temp.bulk_skus")
+        con.executemany("INSERT INTO temp.bulk_skus (sku) VALUES (?)", [(x,) for x in skus])
+        not_found = [
+            r["sku"] for r in con.execute(
+                "SELECT b.sku FROM temp.bulk_skus b LEFT JOIN swabs s ON s.sku = b.sku WHERE s.id IS NULL"
+            )
+        ]
+        already_in_stock = [
+            r["sku"] for r in con.execute(
+                "SELECT s.sku FROM temp.bulk_skus b JOIN swabs s ON s.sku = b.sku "
+                "LEFT JOIN swab_state st ON st.swab_id = s.id "
+                "WHERE COALESCE(st.in_stock, 1) = 1"
+            )
+        ]
+        create_bulk_targets(con)
+        con.execute(
+            "INSERT INTO temp.bulk_targets (swab_id) "
+            "SELECT s.id FROM temp.bulk_skus b JOIN swabs s ON s.sku = b.sku "
+            "JOIN swab_state st ON st.swab_id = s.id WHERE st.in_stock = 0"
+        )
+        returned = bulk_target_skus(con)
+        ts = now_iso()
+        n = bulk_return(con, ts)
+        alerts = check_alert_levels(con, "bulk", "WHERE s.id IN (SELECT swab_id FROM temp.bulk_targets)")
+        drop_bulk_targets(con)
+        con.execute("DROP TABLE IF EXISTS temp.bulk_skus")
+        con.commit()
+    if alerts:
+        alert_dispatcher().wake()
+    return jsonify({
+        "ok": True,
+        "action": "RETURN",
+        "count": n,
+        "skus": returned,
+        "not_found": not_found,
+        "already_in_stock": already_in_stock,
+        "ts": ts,
+    })
+
+
 @app.route("/label/<sku>.png")
 def label_png(sku: str):
-    init_db()
+    ensure_db()
     sku = (sku or "").strip()
     if not sku:
         return "SKU non valido", 400
 
-    with connect() as con:
+    with read_connection() as con:
         sw = get_swab_by_sku(con, sku)
         if not sw:
             return "SKU non trovato", 404
@@ -1040,12 +3557,12 @@ def label_png(sku: str):
 
 @app.route("/label/<sku>/print")
 def label_print(sku: str):
-    init_db()
+    ensure_db()
     sku = (sku or "").strip()
     if not sku:
         return "SKU non valido", 400
 
-    with connect() as con:
+    with read_connection() as con:
         sw = get_swab_by_sku(con, sku)
         if not sw:
             return "SKU non trovato", 404
@@ -1061,14 +3578,14 @@ def label_print(sku: str):
 
 @app.route("/labels/print", methods=["GET", "POST"])
 def labels_print():
-    init_db()
+    ensure_db()
     raw_skus = request.values.getlist("selected_skus")
     selected_skus = [sku.strip() for sku in raw_skus if sku and sku.strip()]
     if not selected_skus:
         return "Nessuno SKU selezionato", 400
 
     labels: List[Dict[str, str]] = []
-    with connect() as con:
+    with read_connection() as con:
         for sku in selected_skus:
             if not sku:
                 return "SKU non valido", 400
@@ -1085,23 +3602,287 @@ def labels_print():
     return render_template("labels_print.html", labels=labels)
 
 
-if __name__ == "__main__":
-    import threading
-    import webbrowser
+def parse_copies(raw: Optional[str]) -> int:
+    try:
+        return max(1, min(int(raw or "1"), 999))
+    except ValueError:
+        return 1
+
+
+@app.route("/label/<sku>.zpl")
+def label_zpl_view(sku: str):
+    ensure_db()
+    sku = (sku or "").strip()
+    if not sku:
+        return "SKU non valido", 400
+
+    with read_connection() as con:
+        sw = get_swab_by_sku(con, sku)
+        if not sw:
+            return "SKU non trovato", 404
+        barcode_settings = get_barcode_settings(con)
+
+    zpl = label_zpl(sku, barcode_settings, copies=parse_copies(request.args.get("copies")))
+    return Response(zpl, mimetype="text/plain")
+
+
+@app.route("/labels/print.zpl", methods=["GET", "POST"])
+def labels_print_zpl():
+    """
+    ZPL di più etichette (selected_skus, copies). In POST con `printer` li invia
+    direttamente alla stampante configurata in ZPL_PRINTERS (solo admin).
+    """
+    ensure_db()
+    raw_skus = request.values.getlist("selected_skus")
+    selected_skus = [sku.strip() for sku in raw_skus if sku and sku.strip()]
+    if not selected_skus:
+        return "Nessuno SKU selezionato", 400
+    copies = parse_copies(request.values.get("copies"))
+    printer = (request.form.get("printer") or "").strip() if request.method == "POST" else ""
+    if printer and not is_logged_in():
+        return redirect(url_for("login", next=url_for("admin_swabs")))
+
+    with read_connection() as con:
+        for sku in selected_skus:
+            if not get_swab_by_sku(con, sku):
+                return f"SKU non trovato: {sku}", 404
+        barcode_settings = get_barcode_settings(con)
+
+    def _chunks() -> Iterator[str]:
+        for sku in selected_skus:
+            yield label_zpl(sku, barcode_settings, copies=copies)
+
+    if not printer:
+        return Response(_chunks(), mimetype="text/plain")
+
+    address = LABEL_PRINTERS.get(printer)
+    if address is None:
+        flash(f"Stampante non configurata: {printer}", "error")
+        return redirect(url_for("admin_swabs"))
+    try:
+        sent = send_to_printer(address, _chunks())
+    except OSError as exc:
+        flash(f"Stampante {printer} non raggiungibile: {exc}", "error")
+        return redirect(url_for("admin_swabs"))
+    flash(f"{len(selected_skus)} etichette inviate a {printer} ({sent} byte).", "ok")
+    return redirect(url_for("admin_swabs"))
+
+
+
+# ---------------------------
+# Asset con impronta e service worker delle pagine di scansione
+# ---------------------------
+_asset_hashes: Dict[str, Tuple[float, str]] = {}
+
+
+def asset_fingerprint(filename: str) -> Optional[str]:
+    """Prime 12 cifre dello sha256 del file in static/, ricalcolate solo se cambia mtime."""
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    mtime = os.path.getmtime(path)
+    cached = _asset_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    _asset_hashes[filename] = (mtime, digest)
+    return digest
+
+
+@app.template_global()
+def asset_url(filename: str) -> str:
+    """static/vendor/x.min.js -> /assets/vendor/x.min.<impronta>.js (cache di un anno); "" se manca."""
+    digest = asset_fingerprint(filename)
+    if digest is None:
+        return ""
+    stem, _, ext = filename.rpartition(".")
+    return url_for("asset", filename=f"{stem}.{digest}.{ext}")
+
+
+@app.route("/assets/<path:filename>")
+def asset(filename: str):
+    stem, _, ext = filename.rpartition(".")
+    base, _, digest = stem.rpartition(".")
+    real = f"{base}.{ext}"
+    current = asset_fingerprint(real) if base else None
+    if current is None:
+        return "Asset non trovato", 404
+    if digest != current:
+        # impronta vecchia (pagina in cache): rimanda alla versione attuale
+        return redirect(asset_url(real))
+    resp = send_from_directory(app.static_folder, real, max_age=ASSET_MAX_AGE)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
+
+def scanner_asset_url() -> str:
+    """html5-qrcode se installato, altrimenti il lettore Code128 incluso; "" se mancano entrambi."""
+    return asset_url(HTML5_QRCODE_ASSET) or asset_url(BUILTIN_SCANNER_ASSET)
+
+
+def scan_precache() -> Dict[str, List[str]]:
+    # pagine e config: subito dalla cache, aggiornate in background;
+    # asset con impronta: mai cambiano, solo dalla cache
+    assets = [url for url in (scanner_asset_url(), asset_url("h7.ico")) if url]
+    return {
+        "pages": [url_for("scan"), url_for("scan_camera"), url_for("api_scan_config")],
+        "assets": assets,
+    }
+
+
+@app.route("/sw.js")
+def service_worker():
+    precache = scan_precache()
+    version = hashlib.sha256(json.dumps(precache, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    resp = Response(
+        render_template("sw.js", precache=precache, version=version),
+        mimetype="application/javascript",
+    )
+    # il browser deve sempre ricontrollare il service worker
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+@app.cli.command("fetch-assets")
+@click.option("--from", "source", default="", help="Copia da un file locale invece di scaricare (impianto senza internet).")
+def fetch_assets_command(source: str) -> None:
+    """Installa html5-qrcode (versione fissata) in static/vendor: da HTML5_QRCODE_URL oppure da un file."""
+    if source:
+        with open(source, "rb") as f:
+            data = f.read()
+    else:
+        import urllib.request
+
+        with urllib.request.urlopen(HTML5_QRCODE_URL, timeout=60) as resp:
+            data = resp.read()
+    if b"Html5Qrcode" not in data:
+        raise click.ClickException(f"{source or HTML5_QRCODE_URL} non sembra html5-qrcode.min.js")
+    dest = os.path.join(app.static_folder, HTML5_QRCODE_ASSET)
+    ensure_dir(os.path.dirname(dest))
+    tmp = f"{dest}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, dest)
+    print(f"{dest} ({len(data)} byte, sha256 {hashlib.sha256(data).hexdigest()})")
+
+
+# ---------------------------
+# Serving (produzione)
+# ---------------------------
+def reset_process_state() -> None:
+    """
+    Stato per-processo da ricreare nel figlio dopo un fork (worker gunicorn):
+    un lock ereditato mentre era acquisito da un altro thread resterebbe bloccato.
+    """
+    global _backup_lock, _label_job_lock, _forecast_cache_lock, _timeline_cache_lock, _read_pools_lock
+    global _ready_sites_lock, _alert_dispatcher, _alert_dispatcher_lock
+    _backup_lock = threading.Lock()
+    _label_job_lock = threading.Lock()
+    _forecast_cache_lock = threading.Lock()
+    _timeline_cache_lock = threading.Lock()
+    _ready_sites_lock = threading.Lock()
+    _read_pools_lock = threading.Lock()
+    _forked_read_pools.extend(_read_pools.values())
+    _read_pools.clear()
+    _label_jobs.clear()
+    # i thread di consegna non sopravvivono al fork: il figlio ne crea di suoi
+    _alert_dispatcher = None
+    _alert_dispatcher_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_process_state)
+
+
+def serve_app(
+    host: str = SERVE_HOST,
+    port: int = SERVE_PORT,
+    workers: int = SERVE_WORKERS,
+    threads: int = SERVE_THREADS,
+    certfile: str = SSL_CERT,
+    keyfile: str = SSL_KEY,
+    pidfile: Optional[str] = None,
+) -> None:
+    """
+    Avvia l'app con un server WSGI di produzione.
+    - Linux/macOS: gunicorn, `workers` processi x `threads` thread; SIGHUP = reload graceful.
+    - Windows: waitress, un solo processo con `threads` thread.
+    """
+    for_each_site(init_db)
+    if asset_fingerprint(HTML5_QRCODE_ASSET) is None:
+        app.logger.warning(
+            "html5-qrcode %s non installato: /scan-camera usa il lettore Code128 incluso (%s); "
+            "per html5-qrcode esegui `flask --app app fetch-assets`", HTML5_QRCODE_VERSION, BUILTIN_SCANNER_ASSET,
+        )
+    workers = max(1, workers)
+    threads = max(1, threads)
+    if bool(certfile) != bool(keyfile):
+        raise SystemExit("TLS: servono sia il certificato sia la chiave privata.")
+
+    if os.name == "nt":
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            raise SystemExit("waitress non installato: pip install waitress")
+        if certfile:
+            raise SystemExit("TLS non supportato da waitress: usa un reverse proxy HTTPS.")
+        start_schedulers()
+        waitress_serve(app, host=host, port=port, threads=threads)
+        return
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("gunicorn non installato: pip install gunicorn")
+
+    def _post_worker_init(worker) -> None:
+        # il master resta senza thread né connessioni: gli scheduler vanno in un solo worker
+        threading.Thread(target=run_schedulers_when_elected, name="scheduler-election", daemon=True).start()
+
+    options: Dict[str, Any] = {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread",
+        "graceful_timeout": 30,
+        "timeout": 60,
+        "post_worker_init": _post_worker_init,
+    }
+    if certfile:
+        options["certfile"] = certfile
+        options["keyfile"] = keyfile
+    if pidfile:
+        options["pidfile"] = pidfile
+
+    class _GunicornApp(BaseApplication):
+        def load_config(self) -> None:
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    _GunicornApp().run()
+
+
+@app.cli.command("serve")
+@click.option("--host", default=SERVE_HOST, show_default=True)
+@click.option("--port", default=SERVE_PORT, show_default=True, type=int)
+@click.option("--workers", default=SERVE_WORKERS, show_default=True, type=int, help="Processi worker.")
+@click.option("--threads", default=SERVE_THREADS, show_default=True, type=int, help="Thread per worker.")
+@click.option("--certfile", default=SSL_CERT, help="Certificato TLS (PEM).")
+@click.option("--keyfile", default=SSL_KEY, help="Chiave privata TLS (PEM).")
+@click.option("--pidfile", default=None, help="File PID del master (per kill -HUP).")
+def serve_command(host, port, workers, threads, certfile, keyfile, pidfile) -> None:
+    """Avvia il server di produzione multi-processo."""
+    serve_app(host, port, workers, threads, certfile, keyfile, pidfile)
+
 
-    init_db()
-    ensure_dir(LABELS_DIR)
-    # accessibile da LAN: host="0.0.0.0" (se vuoi)
-    threading.Timer(1.5, lambda: webbrowser.open(START_URL, new=2)).start()
-    app.run(host="0.0.0.0", port=8086, debug=False)
-'''    
 if __name__ == "__main__":
-    import threading
     import webbrowser
 
-    init_db()
-    ensure_dir(LABELS_DIR)
     # accessibile da LAN: host="0.0.0.0" (se vuoi)
     threading.Timer(1.5, lambda: webbrowser.open(START_URL, new=2)).start()
-    app.run(host="0.0.0.0", port=8086, debug=False, ssl_context=(ssl_cert, ssl_file))
-'''
+    serve_app()
@@ -0,0 +1,241 @@
+"""
+Load test di /api/scan: N scanner concorrenti fanno cicli PRESO/RESO realistici
+su un inventario generato, contro un'istanza avviata in locale (solo localhost).
+
+    python loadtest.py --scanners 16 --duration 30 --swabs 2000 --workers 2 --threads 8
+
+Riporta throughput, latenze p50/p95/p99, errori "database is locked" e verifica
+a fine prova che swab_state / usage_sessions / usage_days coincidano con il
+replay del log movements.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def generate_inventory(swabs: int, machines: int) -> None:
+    # app legge DB_PATH / LABELS_DIR dall'ambiente: importarlo solo dopo averli impostati
+    import app
+
+    app.init_db()
+    with app.connect() as con:
+        con.executemany("INSERT INTO machines (name) VALUES (?)", [(f"LT-M{i:03d}",) for i in range(machines)])
+        ts = app.now_iso()
+        con.executemany(
+            "INSERT INTO swabs (sku, name, created_at) VALUES (?, ?, ?)",
+            [(f"LT-{i:06d}", f"Tampone carico {i}", ts) for i in range(swabs)],
+        )
+        con.execute(
+            "INSERT INTO swab_state (swab_id, in_stock, machine_id, updated_at) "
+            "SELECT id, 1, NULL, created_at FROM swabs"
+        )
+        con.commit()
+
+
+def start_server(port: int, workers: int, threads: int, env: Dict[str, str]) -> subprocess.Popen:
+    cmd = [
+        sys.executable, "-m", "flask", "--app", "app", "serve",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--threads", str(threads),
+    ]
+    proc = subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    url = f"http://127.0.0.1:{port}/api/machines"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit("Il server non è partito:\n" + proc.stderr.read().decode(errors="replace"))
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return proc
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("Timeout in avvio del server.")
+
+
+def post_json(url: str, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.status, json.loads(resp.read() or b"{}")
+    except urllib.error.HTTPError as exc:
+        body = exc.read()
+        try:
+            return exc.code, json.loads(body or b"{}")
+        except ValueError:
+            return exc.code, {"error": body[:200].decode(errors="replace")}
+
+
+class Scanner(threading.Thread):
+    """
+    Una postazione: sceglie un tampone, lo PRENDE su una macchina e più tardi
+    lo RENDE. Ogni scanner lavora sulla propria porzione di inventario, come
+    operatori diversi su banchi diversi.
+    """
+
+    def __init__(self, base_url: str, skus: List[str], machine_ids: List[int],
+                 stop_at: float, think_ms: int, seed: int):
+        super().__init__(daemon=True)
+        self.url = base_url + "/api/scan"
+        self.skus = skus
+        self.machine_ids = machine_ids
+        self.stop_at = stop_at
+        self.think = think_ms / 1000.0
+        self.rng = random.Random(seed)
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.locked = 0
+
+    def run(self) -> None:
+        taken: List[str] = []
+        while time.time() < self.stop_at:
+            if taken and (len(taken) >= 5 or self.rng.random() < 0.5):
+                sku = taken.pop(self.rng.randrange(len(taken)))
+                payload = {"sku": sku, "mode": "RETURN"}
+            else:
+                sku = self.rng.choice(self.skus)
+                if sku in taken:
+                    continue
+                taken.append(sku)
+                payload = {"sku": sku, "mode": "TAKE", "machine_id": self.rng.choice(self.machine_ids)}
+
+            started = time.perf_counter()
+            status, body = post_json(self.url, payload)
+            self.latencies.append(time.perf_counter() - started)
+            if status != 200 or not body.get("ok"):
+                if body.get("locked") or "locked" in str(body.get("error", "")):
+                    self.locked += 1
+                key = f"{status} {body.get('error', '')}".strip()
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if self.think:
+                time.sleep(self.think * self.rng.uniform(0.5, 1.5))
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def check_consistency() -> Dict[str, Any]:
+    import app
+
+    return app.rebuild_derived_tables(workers=1, dry_run=True)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test di /api/scan su un'istanza locale.")
+    parser.add_argument("--scanners", type=int, default=8, help="Scanner concorrenti.")
+    parser.add_argument("--duration", type=float, default=20.0, help="Durata in secondi.")
+    parser.add_argument("--swabs", type=int, default=2000, help="Tamponi nell'inventario generato.")
+    parser.add_argument("--machines", type=int, default=20, help="Macchine nell'inventario generato.")
+    parser.add_argument("--workers", type=int, default=2, help="Processi worker del server.")
+    parser.add_argument("--threads", type=int, default=8, help="Thread per worker.")
+    parser.add_argument("--think-ms", type=int, default=0, help="Pausa media tra due scansioni (ms).")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="Non cancellare la cartella temporanea.")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="tamponi-loadtest-")
+    env = dict(os.environ)
+    env.update({
+        "DB_PATH": os.path.join(workdir, "inventory.db"),
+        "LABELS_DIR": os.path.join(workdir, "labels"),
+        "BACKUP_DIR": os.path.join(workdir, "backups"),
+        "SITES_FILE": os.path.join(workdir, "sites.json"),
+        "BACKUP_INTERVAL_HOURS": "0",
+        "SNAPSHOT_INTERVAL_HOURS": "0",
+    })
+    os.environ.update(env)
+    sys.path.insert(0, APP_DIR)
+
+    proc = None
+    try:
+        generate_inventory(args.swabs, args.machines)
+        port = free_port()
+        proc = start_server(port, args.workers, args.threads, env)
+        base_url = f"http://127.0.0.1:{port}"
+
+        skus = [f"LT-{i:06d}" for i in range(args.swabs)]
+        machine_ids = list(range(1, args.machines + 1))
+        stop_at = time.time() + args.duration
+        scanners = [
+            Scanner(base_url, skus[i::args.scanners], machine_ids, stop_at, args.think_ms, args.seed + i)
+            for i in range(args.scanners)
+        ]
+        started = time.perf_counter()
+        for sc in scanners:
+            sc.start()
+        for sc in scanners:
+            sc.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    latencies = sorted(lat for sc in scanners for lat in sc.latencies)
+    errors: Dict[str, int] = {}
+    for sc in scanners:
+        for key, n in sc.errors.items():
+            errors[key] = errors.get(key, 0) + n
+    locked = sum(sc.locked for sc in scanners)
+    summary = check_consistency()
+
+    print(f"Scanner: {args.scanners}  server: {args.workers} worker x {args.threads} thread  durata: {elapsed:.1f}s")
+    print(f"Richieste: {len(latencies)}  throughput: {len(latencies) / elapsed:.1f} scan/s")
+    print(
+        "Latenza ms  p50: {:.1f}  p95: {:.1f}  p99: {:.1f}  max: {:.1f}".format(
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000,
+            (latencies[-1] if latencies else 0) * 1000,
+        )
+    )
+    print(f"Errori 'database is locked': {locked}")
+    for key, n in sorted(errors.items(), key=lambda kv: -kv[1]):
+        print(f"  {n:6d}  {key}")
+    if summary["diffs"]:
+        print(f"Consistenza: {len(summary['diffs'])} tamponi NON coincidono con il replay dei movimenti")
+        for d in summary["diffs"][:10]:
+            print(f"  {d['sku']}: {', '.join(d['changes'])}")
+    else:
+        print(f"Consistenza: OK ({summary['swabs']} tamponi, stato = replay dei movimenti)")
+
+    if args.keep:
+        print(f"Dati in {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if summary["diffs"] or locked else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+// Service worker delle pagine di scansione (generato da /sw.js).
+// Pagine e /api/scan-config: risposta immediata dalla cache, aggiornata in background.
+// Asset con impronta: solo cache. Tutto il resto (compreso POST /api/scan) va in rete.
+const PREFIX = "tamponi-scan-{{ site.id }}-";
+const CACHE = PREFIX + "{{ version }}";
+const PAGES = {{ precache.pages | tojson }};
+const ASSETS = {{ precache.assets | tojson }};
+
+// senza cookie: la copia in cache non contiene messaggi flash né la sessione admin
+const fetchClean = (url) => fetch(url, { credentials: "omit", cache: "no-cache" });
+
+async function refresh(cache, url) {
+  const resp = await fetchClean(url);
+  if (resp.ok) {
+    await cache.put(url, resp.clone());
+  }
+  return resp;
+}
+
+self.addEventListener("install", (event) => {
+  event.waitUntil(
+    caches.open(CACHE)
+      .then((cache) => Promise.all([...PAGES, ...ASSETS].map((url) => refresh(cache, url).catch(() => null))))
+      .then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((keys) => Promise.all(keys.filter((k) => k.startsWith(PREFIX) && k !== CACHE).map((k) => caches.delete(k))))
+      .then(() => self.clients.claim())
+  );
+});
+
+self.addEventListener("fetch", (event) => {
+  const req = event.request;
+  if (req.method !== "GET") return;
+  const url = new URL(req.url);
+  if (url.origin !== self.location.origin) return;
+
+  if (ASSETS.includes(url.pathname)) {
+    event.respondWith(
+      caches.open(CACHE).then(async (cache) => (await cache.match(url.pathname)) || refresh(cache, url.pathname))
+    );
+    return;
+  }
+
+  if (PAGES.includes(url.pathname)) {
+    event.respondWith(
+      caches.open(CACHE).then(async (cache) => {
+        const cached = await cache.match(url.pathname);
+        const network = refresh(cache, url.pathname);
+        if (cached) {
+          event.waitUntil(network.catch(() => null));
+          return cached;
+        }
+        return network;
+      })
+    );
+  }
+});
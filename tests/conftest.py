@@ -0,0 +1,41 @@
+"""
+Configurazione comune dei test: app legge DB_PATH / LABELS_DIR / ... dall'ambiente
+al momento dell'import, quindi vanno impostati qui, prima che un test importi app.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix="tamponi-test-")
+
+os.environ.update({
+    "DB_PATH": os.path.join(TEST_DIR, "inventory.db"),
+    "LABELS_DIR": os.path.join(TEST_DIR, "labels"),
+    "BACKUP_DIR": os.path.join(TEST_DIR, "backups"),
+    "SITES_FILE": os.path.join(TEST_DIR, "sites.json"),
+    "BACKUP_INTERVAL_HOURS": "0",
+    "SNAPSHOT_INTERVAL_HOURS": "0",
+})
+sys.path.insert(0, APP_DIR)
+
+
+@pytest.fixture
+def test_env():
+    """Ambiente per i processi figli che importano app."""
+    return dict(os.environ, PYTHONPATH=APP_DIR)
+
+
+@pytest.fixture
+def app_module():
+    import app
+
+    app.init_db()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
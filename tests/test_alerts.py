@@ -0,0 +1,205 @@
+"""
+Notifiche superamento soglie con destinazioni finte in locale: un server HTTP
+al posto del webhook, un socket UDP al posto di syslog, file temporanei.
+"""
+import http.server
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+
+class FlakyWebhook(http.server.BaseHTTPRequestHandler):
+    """Risponde 503 alle prime `failures` richieste, poi 200."""
+
+    failures = 0
+    received: list = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        cls = type(self)
+        if cls.failures > 0:
+            cls.failures -= 1
+            self.send_response(503)
+        else:
+            cls.received.append(json.loads(body))
+            self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class DeadSink:
+    name = "dead"
+
+    def __init__(self):
+        self.calls = 0
+
+    def send(self, events):
+        self.calls += 1
+        raise ConnectionRefusedError("destinazione ferma")
+
+
+@pytest.fixture
+def webhook():
+    handler = type("Handler", (FlakyWebhook,), {"failures": 2, "received": []})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield handler, f"http://127.0.0.1:{server.server_address[1]}/hook"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dispatchers(app_module, monkeypatch):
+    """Sostituisce il dispatcher globale; i thread vengono fermati a fine test."""
+    created = []
+
+    def install(sinks, **kwargs):
+        kwargs.setdefault("batch_seconds", 0)
+        kwargs.setdefault("backoff", 0.05)
+        kwargs.setdefault("poll_seconds", 0.05)
+        d = app_module.AlertDispatcher(sinks, **kwargs)
+        monkeypatch.setattr(app_module, "_alert_dispatcher", d)
+        created.append(d)
+        return d
+
+    with app_module.connect() as con:
+        con.execute("DELETE FROM alert_outbox")
+        con.commit()
+    yield install
+    for d in created:
+        d.stop()
+
+
+@pytest.fixture
+def aged_swab(app_module):
+    """Un tampone con 5 giorni d'uso, soglie avviso 3 / allarme 10, e una macchina."""
+    sku = f"AL-{time.time_ns()}"
+    with app_module.connect() as con:
+        app_module.set_setting(con, app_module.SETTINGS_KEY_WARN_DAYS, "3")
+        app_module.set_setting(con, app_module.SETTINGS_KEY_ALARM_DAYS, "10")
+        swab_id = con.execute(
+            "INSERT INTO swabs (sku, name, created_at) VALUES (?, 'Tampone test', ?)",
+            (sku, app_module.now_iso()),
+        ).lastrowid
+        con.execute(
+            "INSERT INTO swab_state (swab_id, in_stock, machine_id, updated_at) VALUES (?, 1, NULL, ?)",
+            (swab_id, app_module.now_iso()),
+        )
+        con.executemany(
+            "INSERT INTO usage_days (swab_id, day) VALUES (?, ?)",
+            [(swab_id, f"2020-01-0{d}") for d in range(1, 6)],
+        )
+        machine_id = con.execute("INSERT INTO machines (name) VALUES (?)", (f"M-{sku}",)).lastrowid
+        con.commit()
+    return {"id": swab_id, "sku": sku, "machine_id": machine_id}
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+def test_scan_crossing_reaches_webhook_after_retries(app_module, client, dispatchers, webhook, aged_swab):
+    handler, url = webhook
+    # polling lento: i tentativi successivi devono partire dal backoff, non dal polling
+    d = dispatchers([app_module.WebhookSink(url, timeout=2)], poll_seconds=30)
+
+    r = client.post("/api/scan", json={"sku": aged_swab["sku"], "mode": "TAKE", "machine_id": aged_swab["machine_id"]})
+    assert r.get_json()["warning"] is True
+
+    assert d.flush(timeout=5)
+    assert len(handler.received) == 1
+    (event,) = handler.received[0]["events"]
+    assert (event["sku"], event["level"], event["source"]) == (aged_swab["sku"], "warn", "scan")
+
+
+def test_crossing_is_notified_once(app_module, client, dispatchers, tmp_path, aged_swab):
+    out = tmp_path / "alerts.jsonl"
+    d = dispatchers([app_module.FileSink(str(out))])
+    for mode in ("TAKE", "RETURN", "TAKE"):
+        client.post("/api/scan", json={"sku": aged_swab["sku"], "mode": mode, "machine_id": aged_swab["machine_id"]})
+    assert d.flush(timeout=5)
+    assert len(out.read_text().splitlines()) == 1
+
+
+def test_dead_sink_does_not_delay_other_sinks(app_module, client, dispatchers, tmp_path, aged_swab):
+    out = tmp_path / "alerts.jsonl"
+    dead = DeadSink()
+    dispatchers([dead, app_module.FileSink(str(out))], backoff=60)
+
+    client.post("/api/scan", json={"sku": aged_swab["sku"], "mode": "TAKE", "machine_id": aged_swab["machine_id"]})
+
+    assert wait_for(lambda: out.exists() and out.read_text().strip())
+    assert dead.calls >= 1
+    # la notifica per la destinazione ferma resta in coda, non viene persa
+    with app_module.connect() as con:
+        row = con.execute("SELECT attempts, last_error FROM alert_outbox WHERE sink = 'dead'").fetchone()
+    assert row["attempts"] >= 1
+    assert "destinazione ferma" in row["last_error"]
+
+
+def test_pending_notifications_survive_a_restart(app_module, dispatchers, tmp_path, aged_swab):
+    out = tmp_path / "alerts.jsonl"
+    sink = app_module.FileSink(str(out))
+    # primo processo: registra il superamento ma "muore" prima di consegnare
+    first = dispatchers([sink])
+    with app_module.connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        events = app_module.check_alert_levels(con, "aging", "WHERE s.id = ?", (aged_swab["id"],))
+        con.commit()
+    assert len(events) == 1
+    assert first.pending() == 1
+    assert not out.exists()
+
+    # nuovo processo: nessuna nuova scansione, la coda su DB viene ripresa dal polling
+    second = dispatchers([sink])
+    second.start()
+    assert wait_for(lambda: second.pending() == 0)
+    assert json.loads(out.read_text())["sku"] == aged_swab["sku"]
+
+
+def test_enqueue_does_not_delay_the_scan(app_module, client, dispatchers, aged_swab):
+    class SlowSink:
+        name = "slow"
+
+        def send(self, events):
+            time.sleep(2)
+
+    dispatchers([SlowSink()])
+    started = time.perf_counter()
+    r = client.post("/api/scan", json={"sku": aged_swab["sku"], "mode": "TAKE", "machine_id": aged_swab["machine_id"]})
+    assert r.get_json()["ok"]
+    assert time.perf_counter() - started < 1
+
+
+def test_syslog_sink_logs_each_event_once(app_module):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.settimeout(0.5)
+    address = f"127.0.0.1:{listener.getsockname()[1]}"
+    try:
+        app_module.SyslogSink(address)
+        sink = app_module.SyslogSink(address)
+        sink.send([{
+            "site_name": "Test", "sku": "SYS-1", "name": "Tampone", "level": "alarm",
+            "current_days": 0, "total_days": 12, "warn_days": 3, "alarm_days": 10,
+        }])
+        lines = []
+        try:
+            while True:
+                lines.append(listener.recv(4096))
+        except socket.timeout:
+            pass
+    finally:
+        listener.close()
+    assert len(lines) == 1
+    assert b"SYS-1" in lines[0]
@@ -0,0 +1,101 @@
+"""Asset con impronta e scanner della fotocamera servito solo in locale (nessuna CDN)."""
+import json
+import shutil
+import subprocess
+
+import pytest
+
+FAKE_LIBRARY = b"/* html5-qrcode 2.3.8 (finto per i test) */ var Html5Qrcode = function () {};"
+
+
+@pytest.fixture
+def static_dir(app_module, tmp_path, monkeypatch):
+    shutil.copy(f"{app_module.app.static_folder}/h7.ico", tmp_path / "h7.ico")
+    (tmp_path / "vendor").mkdir()
+    shutil.copy(f"{app_module.app.static_folder}/{app_module.BUILTIN_SCANNER_ASSET}", tmp_path / "vendor")
+    monkeypatch.setattr(app_module.app, "static_folder", str(tmp_path))
+    app_module._asset_hashes.clear()
+    yield tmp_path
+    app_module._asset_hashes.clear()
+
+
+def test_builtin_scanner_is_the_default(app_module, client, static_dir):
+    r = client.get("/scan-camera")
+    assert r.status_code == 200
+    with app_module.app.test_request_context():
+        url = app_module.asset_url(app_module.BUILTIN_SCANNER_ASSET)
+    assert url.startswith("/assets/vendor/code128-scanner.") and url.endswith(".js")
+    body = r.get_data(as_text=True)
+    assert f'<script src="{url}">' in body
+    assert "unpkg" not in body
+    assert client.get(url).status_code == 200
+    assert url in client.get("/sw.js").get_data(as_text=True)
+
+
+def test_missing_scanner_files_fail_loudly(app_module, client, static_dir):
+    (static_dir / app_module.BUILTIN_SCANNER_ASSET).unlink()
+    r = client.get("/scan-camera")
+    assert r.status_code == 503
+    body = r.get_data(as_text=True)
+    assert "fetch-assets" in body
+    assert "unpkg" not in body and "<script src=" not in body
+
+
+def test_installed_library_is_served_fingerprinted(app_module, client, static_dir):
+    runner = app_module.app.test_cli_runner()
+    src = static_dir / "download.js"
+    src.write_bytes(FAKE_LIBRARY)
+    result = runner.invoke(args=["fetch-assets", "--from", str(src)])
+    assert result.exit_code == 0, result.output
+
+    r = client.get("/scan-camera")
+    assert r.status_code == 200
+    with app_module.app.test_request_context():
+        url = app_module.asset_url(app_module.HTML5_QRCODE_ASSET)
+    assert url.startswith("/assets/vendor/html5-qrcode.min.") and url.endswith(".js")
+    assert f'<script src="{url}">' in r.get_data(as_text=True)
+
+    js = client.get(url)
+    assert js.data == FAKE_LIBRARY
+    assert "immutable" in js.headers["Cache-Control"]
+    sw = client.get("/sw.js").get_data(as_text=True)
+    assert url in sw and "code128-scanner" not in sw
+
+
+def test_fetch_assets_rejects_wrong_file(app_module, static_dir):
+    src = static_dir / "page.html"
+    src.write_bytes(b"<html>404</html>")
+    result = app_module.app.test_cli_runner().invoke(args=["fetch-assets", "--from", str(src)])
+    assert result.exit_code != 0
+    assert not (static_dir / "vendor" / "html5-qrcode.min.js").exists()
+
+
+def test_stale_fingerprint_redirects(client, static_dir):
+    r = client.get("/assets/h7.000000000000.ico")
+    assert r.status_code == 302
+    assert client.get(r.headers["Location"]).status_code == 200
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="serve node per eseguire il lettore JavaScript")
+def test_builtin_scanner_decodes_printed_labels(app_module):
+    from PIL import Image
+
+    skus = ["TMP-0001", "ABC-1", "123456789012", "Lab2_tamp.7"]
+    lines = []
+    for sku in skus:
+        img = Image.open(app_module.ensure_label_png(sku)).convert("L")
+        # come da fotocamera: meno di 2 pixel per modulo, anche letto al contrario
+        img = img.resize((img.width // 2, img.height), Image.BILINEAR)
+        row = [img.getpixel((x, img.height // 2)) for x in range(img.width)]
+        lines += [row, row[::-1]]
+
+    script = (
+        "const fs = require('fs');"
+        "require(process.argv[1]);"
+        "const lines = JSON.parse(fs.readFileSync(0, 'utf8'));"
+        "console.log(JSON.stringify(lines.map(l => Code128Scanner.decodeLine(l))));"
+    )
+    scanner = f"{app_module.app.static_folder}/{app_module.BUILTIN_SCANNER_ASSET}"
+    out = subprocess.run(["node", "-e", script, scanner], input=json.dumps(lines),
+                         capture_output=True, text=True, check=True, timeout=30)
+    assert json.loads(out.stdout) == [sku for sku in skus for _ in range(2)]
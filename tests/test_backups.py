@@ -0,0 +1,13 @@
+"""Backup online e rotazione delle copie."""
+
+
+def test_keep_zero_keeps_every_backup(app_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "site_backup_dir", lambda: str(tmp_path))
+    paths = [app_module.backup_db(compress=False, keep=0) for _ in range(3)]
+    assert sorted(b["name"] for b in app_module.list_backups()) == sorted(p.rsplit("/", 1)[1] for p in paths)
+
+
+def test_rotation_keeps_newest(app_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "site_backup_dir", lambda: str(tmp_path))
+    paths = [app_module.backup_db(compress=False, keep=2) for _ in range(3)]
+    assert [b["name"] for b in app_module.list_backups()] == [p.rsplit("/", 1)[1] for p in reversed(paths[1:])]
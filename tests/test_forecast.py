@@ -0,0 +1,23 @@
+"""Previsione in cache: deve seguire le modifiche fatte dall'admin."""
+import time
+
+
+def test_forecast_follows_swab_rename(app_module, client):
+    sku = f"FC-{time.time_ns()}"
+    with app_module.connect() as con:
+        swab_id = con.execute(
+            "INSERT INTO swabs (sku, name, created_at) VALUES (?, 'Nome vecchio', ?)",
+            (sku, app_module.now_iso()),
+        ).lastrowid
+        con.commit()
+        before = {f["id"]: f["name"] for f in app_module.get_forecast(con)}
+    assert before[swab_id] == "Nome vecchio"
+
+    with client.session_transaction() as sess:
+        sess["admin_sites"] = [app_module.DEFAULT_SITE_ID]
+    r = client.post(f"/swabs/{swab_id}/edit", data={"name": "Nome nuovo", "sku": sku})
+    assert r.status_code == 302
+
+    with app_module.connect() as con:
+        after = {f["id"]: f["name"] for f in app_module.get_forecast(con)}
+    assert after[swab_id] == "Nome nuovo"
@@ -0,0 +1,63 @@
+"""/api/scan: contesto letto sotto lock di scrittura e requisito di versione SQLite."""
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def swabs(app_module):
+    prefix = f"SC-{time.time_ns()}"
+    with app_module.connect() as con:
+        machine_id = con.execute("INSERT INTO machines (name) VALUES (?)", (f"M-{prefix}",)).lastrowid
+        skus = []
+        for i in range(20):
+            sku = f"{prefix}-{i}"
+            swab_id = con.execute(
+                "INSERT INTO swabs (sku, name, created_at) VALUES (?, 'Tampone', ?)",
+                (sku, app_module.now_iso()),
+            ).lastrowid
+            con.execute(
+                "INSERT INTO swab_state (swab_id, in_stock, machine_id, updated_at) VALUES (?, 1, NULL, ?)",
+                (swab_id, app_module.now_iso()),
+            )
+            skus.append(sku)
+        con.commit()
+    return skus, machine_id
+
+
+def test_concurrent_take_opens_one_session(app_module, swabs):
+    skus, machine_id = swabs
+    stations = 4
+    barrier = threading.Barrier(stations)
+    errors = []
+
+    def station():
+        client = app_module.app.test_client()
+        for sku in skus:
+            barrier.wait()
+            r = client.post("/api/scan", json={"sku": sku, "mode": "TAKE", "machine_id": machine_id})
+            if r.status_code != 200:
+                errors.append(r.status_code)
+
+    threads = [threading.Thread(target=station) for _ in range(stations)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    with app_module.connect() as con:
+        rows = con.execute(
+            "SELECT s.sku, COUNT(us.id) AS n FROM swabs s "
+            "JOIN usage_sessions us ON us.swab_id = s.id AND us.returned_ts IS NULL "
+            f"WHERE s.sku IN ({','.join('?' * len(skus))}) GROUP BY s.id",
+            skus,
+        ).fetchall()
+    assert {r["sku"]: r["n"] for r in rows} == {sku: 1 for sku in skus}
+
+
+def test_old_sqlite_is_rejected_at_startup(app_module, monkeypatch):
+    monkeypatch.setattr(app_module.sqlite3, "sqlite_version_info", (3, 34, 1))
+    with pytest.raises(RuntimeError, match="3.35"):
+        app_module.init_db()
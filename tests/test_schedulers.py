@@ -0,0 +1,29 @@
+"""Elezione del worker che esegue gli scheduler sotto gunicorn."""
+import fcntl
+import os
+import threading
+
+import pytest
+
+
+@pytest.mark.skipif(os.name == "nt", reason="flock solo su POSIX")
+def test_schedulers_wait_for_the_elected_worker(app_module, tmp_path, monkeypatch):
+    started = threading.Event()
+    monkeypatch.setattr(app_module, "start_schedulers", started.set)
+    monkeypatch.setattr(app_module, "_scheduler_lock_fd", None)
+    lock_path = str(tmp_path / "scheduler.lock")
+
+    # un altro "worker" tiene già il lock
+    holder = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(holder, fcntl.LOCK_EX)
+    t = threading.Thread(target=app_module.run_schedulers_when_elected, args=(lock_path,), daemon=True)
+    t.start()
+    assert not started.wait(0.3)
+
+    # il worker eletto esce: il lock passa a chi era in attesa
+    os.close(holder)
+    assert started.wait(5)
+    t.join(5)
+    with open(lock_path) as fh:
+        assert fh.read().strip() == str(os.getpid())
+    os.close(app_module._scheduler_lock_fd)
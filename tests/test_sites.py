@@ -0,0 +1,18 @@
+"""Riepilogo multi-sito."""
+
+
+def test_summary_of_an_empty_site(app_module, tmp_path, monkeypatch):
+    monkeypatch.setitem(app_module.SITES, "vuoto", {
+        "id": "vuoto",
+        "name": "Sito vuoto",
+        "db": str(tmp_path / "inventory.db"),
+        "labels": str(tmp_path / "labels"),
+        "backups": str(tmp_path / "backups"),
+        "hosts": [],
+    })
+    with app_module.use_site("vuoto"):
+        summary = app_module.site_summary()
+    assert summary["swabs"] == summary["taken"] == summary["machines"] == 0
+    assert summary["last_movement_ts"] is None
+    assert summary["warning"] == summary["alarm"] == 0
+    assert summary["error"] is None
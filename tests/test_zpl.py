@@ -0,0 +1,93 @@
+"""
+Etichette ZPL e invio raw TCP: un listener socketserver su 127.0.0.1 fa da
+stampante (porta 9100) e raccoglie i byte ricevuti.
+"""
+import socketserver
+import threading
+import time
+
+import pytest
+
+
+class PrinterHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        chunks = []
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+        self.server.jobs.append(b"".join(chunks))
+
+
+@pytest.fixture
+def printer():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), PrinterHandler)
+    server.jobs = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def skus(app_module):
+    prefix = f"ZPL-{time.time_ns()}"
+    skus = [f"{prefix}-{i}" for i in range(3)]
+    with app_module.connect() as con:
+        for sku in skus:
+            con.execute(
+                "INSERT INTO swabs (sku, name, created_at) VALUES (?, 'Tampone ZPL', ?)",
+                (sku, app_module.now_iso()),
+            )
+        con.commit()
+    return skus
+
+
+def wait_for_job(server, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not server.jobs and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert server.jobs, "la stampante finta non ha ricevuto nulla"
+    return server.jobs[0]
+
+
+def test_send_to_printer_delivers_zpl_payload(app_module, printer):
+    settings = {
+        "module_width": 0.3, "module_height": 9.0, "quiet_zone": 6.0,
+        "font_size": 9, "text_distance": 1.5, "write_text": False,
+    }
+    payload = app_module.label_zpl("ABC-1", settings)
+    sent = app_module.send_to_printer(printer.server_address, [payload])
+
+    job = wait_for_job(printer)
+    assert sent == len(job)
+    assert job == payload.encode("utf-8")
+    assert job.startswith(b"^XA") and job.rstrip().endswith(b"^XZ")
+    assert b"^BCN," in job and b"^FDABC-1^FS" in job
+
+
+def test_bulk_print_streams_labels_to_configured_printer(app_module, client, printer, skus, monkeypatch):
+    monkeypatch.setitem(app_module.LABEL_PRINTERS, "Banco", printer.server_address)
+    with client.session_transaction() as sess:
+        sess["admin_sites"] = [app_module.DEFAULT_SITE_ID]
+
+    r = client.post("/labels/print.zpl", data={"selected_skus": skus, "copies": "2", "printer": "Banco"})
+    assert r.status_code == 302
+
+    job = wait_for_job(printer)
+    expected = client.get("/labels/print.zpl", query_string={"selected_skus": skus, "copies": "2"}).data
+    assert job == expected
+    assert job.count(b"^XA") == job.count(b"^XZ") == len(skus)
+    assert job.count(b"^PQ2") == len(skus)
+    for sku in skus:
+        assert f"^FD{sku}^FS".encode() in job
+
+
+def test_bulk_print_requires_login(client, printer, skus, app_module, monkeypatch):
+    monkeypatch.setitem(app_module.LABEL_PRINTERS, "Banco", printer.server_address)
+    r = client.post("/labels/print.zpl", data={"selected_skus": skus, "printer": "Banco"})
+    assert r.status_code == 302
+    assert "/login" in r.headers["Location"]
+    time.sleep(0.1)
+    assert printer.jobs == []